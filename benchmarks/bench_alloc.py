@@ -0,0 +1,53 @@
+"""benchmark throughput and RSS of the malloc and pool allocators"""
+import os
+import subprocess
+import sys
+import time
+from ffilupa import LuaRuntime
+
+
+REQUEST = '''
+function(n)
+    local rows = {}
+    for i = 1, n do
+        local row = {id = i, name = 'row' .. i, tags = {i, i + 1, i + 2}}
+        for j = 1, i % 16 do
+            row[j] = {j, tostring(j)}
+        end
+        rows[#rows + 1] = row
+    end
+    return #rows
+end
+'''
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run(allocator, requests=2000, runtimes=8):
+    runtimes = [LuaRuntime(allocator=allocator) for _ in range(runtimes)]
+    funcs = [lua.eval(REQUEST) for lua in runtimes]
+    start_rss = rss()
+    start = time.perf_counter()
+    for i in range(requests):
+        funcs[i % len(funcs)](200 + i % 50)
+    elapsed = time.perf_counter() - start
+    print('{:<7} {:8.1f} requests/s  RSS +{:6.1f} MB'.format(
+        allocator, requests / elapsed, (rss() - start_rss) / 1024 / 1024))
+    del funcs
+    for lua in runtimes:
+        lua.close()
+
+
+def main():
+    for allocator in ('malloc', 'pool'):
+        subprocess.check_call([sys.executable, __file__, allocator])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        main()
@@ -0,0 +1,20 @@
+"""benchmark the overhead of calling lua functions from python"""
+import timeit
+from ffilupa import LuaRuntime
+
+
+def main(number=100000):
+    lua = LuaRuntime()
+    cases = (
+        ('no args', lua.eval('function() end'), ()),
+        ('3 args', lua.eval('function(a, b, c) return a end'), (1, 2.5, 'awd')),
+        ('3 returns', lua.eval('function() return 1, 2.5, "awd" end'), ()),
+        ('30 args', lua.eval('function(...) return ... end'), (1, 2.5, True, 'awd', b'dwa', None) * 5),
+    )
+    for name, func, args in cases:
+        t = min(timeit.repeat(lambda: func(*args), number=number, repeat=3))
+        print('{:<12} {:8.3f} us/call'.format(name, t / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""benchmark indexing, calling, pulling and iterating in each runtime mode"""
+import timeit
+from ffilupa import LuaRuntime
+
+
+MODES = (
+    ('default', {}),
+    ('unchecked', {'check_stack_balance': False}),
+    ('confined', {'threadsafe': False, 'check_stack_balance': False}),
+)
+
+
+def main(number=20000):
+    for mode, kwargs in MODES:
+        lua = LuaRuntime(**kwargs)
+        tb = lua.table(1, 2.5, 'awd')
+        func = lua.eval('function(a) return a end')
+        big = lua.eval('(function() local t = {} for i = 1, 1000 do t[i] = i end return t end)()')
+        cases = (
+            ('index', lambda: tb[3]),
+            ('call', lambda: func(1)),
+            ('pull', lambda: tb.pull()),
+            ('items', lambda: dict(big.items())),
+        )
+        for name, stmt in cases:
+            n = number // 1000 if name == 'items' else number
+            t = min(timeit.repeat(stmt, number=n, repeat=3))
+            print('{:<10} {:<6} {:8.3f} us/op'.format(mode, name, t / n * 1e6))
+
+
+if __name__ == '__main__':
+    main()
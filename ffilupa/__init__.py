@@ -14,6 +14,9 @@ from .exception import *
 from .protocol import *
 from .compat import *
 from .lualibs import *
+from .bytecode import *
+from .pool import *
+from .executor import *
 
 def _gen_all():
     global __all__
@@ -22,5 +25,9 @@ def _gen_all():
     from . import protocol as _prc
     from . import compat as _cp
     from . import lualibs as _ll
-    __all__ = _rt.__all__ + _exc.__all__ + _prc.__all__ + _cp.__all__ + _ll.__all__
+    from . import bytecode as _bc
+    from . import pool as _pl
+    from . import executor as _ex
+    __all__ = _rt.__all__ + _exc.__all__ + _prc.__all__ + _cp.__all__ + _ll.__all__ + _bc.__all__ + _pl.__all__ + \
+        _ex.__all__
 _gen_all(); del _gen_all
@@ -0,0 +1,81 @@
+"""module contains the asyncio bridge for lua coroutines"""
+
+
+__all__ = ('drive', 'iterate', 'create_task')
+
+import asyncio
+import inspect
+from .py_from_lua import LuaThread
+
+
+def _isawaitable(obj):
+    """
+    Whether ``obj`` is awaited when yielded. Lua coroutines are
+    awaitable, but yielding one passes it on as a plain value.
+    """
+    return not isinstance(obj, LuaThread) and inspect.isawaitable(obj)
+
+
+def _resume(thread, args):
+    """
+    Resume ``thread`` with ``args``. Returns a tuple ``(state, value)``,
+    ``state`` is ``'yield'``, ``'return'`` or ``'stop'`` if the coroutine
+    finished without returning any value.
+    """
+    try:
+        if thread._isfirst:
+            rv = next(thread)
+        else:
+            rv = thread.send(*args)
+    except StopIteration:
+        return 'stop', None
+    return ('yield' if thread else 'return'), rv
+
+
+async def drive(thread):
+    """
+    Run the LuaThread ``thread`` to the end and returns its return value.
+
+    When the lua coroutine yields a python awaitable, it's awaited and
+    the coroutine is resumed with the result. If the awaitable raises,
+    the exception propagates here and the coroutine stays suspended.
+    Other yielded values, including lua coroutines, are dropped, and
+    the coroutine is resumed with nothing after giving other tasks a
+    chance to run.
+    """
+    args = ()
+    while True:
+        state, rv = _resume(thread, args)
+        if state != 'yield':
+            return rv
+        if _isawaitable(rv):
+            args = (await rv,)
+        else:
+            await asyncio.sleep(0)
+            args = ()
+
+
+async def iterate(thread):
+    """
+    An async generator over the values yielded by the LuaThread ``thread``,
+    like iterating it synchronously. Yielded awaitables are awaited and
+    the coroutine is resumed with the result, as in :py:func:`drive`.
+    """
+    args = ()
+    while True:
+        state, rv = _resume(thread, args)
+        if state == 'stop':
+            return
+        if state == 'return':
+            yield rv
+            return
+        if _isawaitable(rv):
+            args = (await rv,)
+        else:
+            yield rv
+            args = ()
+
+
+def create_task(thread):
+    """Wrap the LuaThread ``thread`` in an asyncio task. See :py:func:`drive`."""
+    return asyncio.ensure_future(drive(thread))
@@ -0,0 +1,156 @@
+"""module contains the on-disk bytecode cache for lua source files"""
+
+
+__all__ = ('BytecodeCache',)
+
+import os
+import struct
+import hashlib
+from .exception import *
+from .util import *
+from .py_from_lua import LuaCallable, LuaVolatile
+
+
+class BytecodeCache:
+    """
+    Cache compiled lua chunks on disk, like ``__pycache__``.
+
+    An entry is keyed by the path of the source file, its mtime and size,
+    and the lua lib name and version. Stale or broken entries are
+    ignored and rewritten.
+
+    Pass an instance as ``bytecode_cache`` to :py:class:`ffilupa.runtime.LuaRuntime`
+    to use it in ``compile_path`` and ``require``.
+    """
+
+    #: magic bytes at the head of each cache file
+    MAGIC = b'FLBC'
+    _header = struct.Struct('<4sqQ')
+
+    def __init__(self, directory=None, *, strip=False):
+        """
+        Init a bytecode cache.
+
+        :param directory: where to write cache files. If None, they're
+            written into a ``__luacache__`` directory next to the source file
+        :param strip: whether to strip debug information from the bytecode.
+            Only lua 5.3 supports stripping
+        """
+        if directory is not None:
+            directory = os.fsencode(directory)
+        self.directory = directory
+        self.strip = strip
+
+    def tag(self, runtime):
+        """Returns the tag in cache file names for ``runtime``"""
+        tag = '{}-{}'.format(runtime.lualib.name, runtime.lualib.version)
+        if self.strip:
+            tag += '-s'
+        return tag
+
+    def cache_path(self, runtime, pathname):
+        """Returns the path of the cache file of lua source file ``pathname``"""
+        pathname = os.path.abspath(os.fsencode(pathname))
+        tag = self.tag(runtime).encode('ascii')
+        if self.directory is None:
+            dirname, basename = os.path.split(pathname)
+            return os.path.join(dirname, b'__luacache__', basename + b'.' + tag + b'.luac')
+        else:
+            digest = hashlib.sha1(pathname).hexdigest().encode('ascii')
+            return os.path.join(self.directory, digest + b'.' + tag + b'.luac')
+
+    def load(self, runtime, pathname):
+        """
+        Compile lua source file ``pathname`` in ``runtime``, using the
+        cached bytecode if it's fresh. Otherwise the source is compiled
+        and the bytecode is written to the cache.
+        """
+        pathname = os.fsencode(pathname)
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            return self._loadfile(runtime, pathname)
+        cpath = self.cache_path(runtime, pathname)
+        data = self._read(cpath, st)
+        if data is not None:
+            func = self._loadbuffer(runtime, data, pathname)
+            if func is not None:
+                return func
+        func = self._loadfile(runtime, pathname)
+        self._write(cpath, st, self._dump(runtime, func))
+        return func
+
+    def install(self, runtime):
+        """
+        Install a searcher into ``package.searchers`` of ``runtime``,
+        right before the lua searcher, so that ``require`` loads lua
+        modules through this cache.
+        """
+        runtime.eval('''
+            function(load, package)
+                local searchpath = package.searchpath
+                table.insert(package.searchers or package.loaders, 2, function(name)
+                    local path, err = searchpath(name, package.path)
+                    if not path then
+                        return err
+                    end
+                    return load(path), path
+                end)
+            end''')(lambda path: self.load(runtime, path), runtime.globals().package)
+
+    def _read(self, cpath, st):
+        try:
+            with open(cpath, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        header = self._header
+        if len(data) < header.size:
+            return None
+        magic, mtime, size = header.unpack_from(data)
+        if magic != self.MAGIC or mtime != st.st_mtime_ns or size != st.st_size:
+            return None
+        return data[header.size:]
+
+    def _write(self, cpath, st, data):
+        tmp = cpath + b'.' + str(os.getpid()).encode('ascii')
+        try:
+            os.makedirs(os.path.dirname(cpath), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(self._header.pack(self.MAGIC, st.st_mtime_ns, st.st_size))
+                f.write(data)
+            os.replace(tmp, cpath)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _loadfile(runtime, pathname):
+        lib = runtime.lib
+        with lock_get_state(runtime) as L:
+            with ensure_stack_balance(runtime):
+                status = lib.luaL_loadfile(L, pathname)
+                obj = runtime.pull(-1)
+                if status != lib.LUA_OK:
+                    raise LuaErr.new(runtime, status, obj, runtime.encoding)
+                else:
+                    return obj
+
+    @staticmethod
+    def _loadbuffer(runtime, data, pathname):
+        lib = runtime.lib
+        with lock_get_state(runtime) as L:
+            with ensure_stack_balance(runtime):
+                status = lib._loadbufferx(L, data, len(data), b'@' + pathname, b'b')
+                if status == lib.LUA_OK:
+                    return runtime.pull(-1)
+
+    def _dump(self, runtime, func):
+        lib = runtime.lib
+        with lock_get_state(runtime) as L:
+            with ensure_stack_balance(runtime):
+                lib.lua_pushcfunction(L, lib._get_dump_client())
+                return LuaCallable.__call__(LuaVolatile(runtime, -1), func, self.strip,
+                                            set_metatable=False, autodecode=False)
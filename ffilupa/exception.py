@@ -10,6 +10,7 @@ __all__ = (
     'LuaErrMem',
     'LuaErrGCMM',
     'LuaErrErr',
+    'LuaErrBudget',
 )
 
 
@@ -81,3 +82,6 @@ class LuaErrGCMM(LuaErr):
 class LuaErrErr(LuaErr):
     """Exception LuaErrErr"""
     pass
+class LuaErrBudget(LuaErrRun):
+    """Exception LuaErrBudget. Raised when a call runs out of its instruction or time limit."""
+    pass
@@ -0,0 +1,232 @@
+"""module contains LuaProcessExecutor, which runs lua functions in worker processes"""
+
+
+__all__ = ('LuaProcessExecutor',)
+
+import os
+import queue
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import Future
+from .runtime import LuaRuntime
+from .py_from_lua import LuaObject, LuaTable
+from .util import *
+
+
+def _rss():
+    """resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _to_python(obj):
+    """convert a value pulled from lua into picklable python objects"""
+    if isinstance(obj, LuaTable):
+        return obj.to_python(sequence=None, on_object=_to_python)
+    elif isinstance(obj, LuaObject):
+        raise TypeError('cannot transfer lua {} from worker'.format(obj.typename()))
+    elif isinstance(obj, tuple):
+        return tuple(_to_python(x) for x in obj)
+    else:
+        return obj
+
+
+def _worker_main(runtime, address, authkey, max_tasks, max_memory):
+    """the loop of a worker process, forked from the template"""
+    conn = Client(address, authkey=authkey)
+    funcs = {}
+    tasks = 0
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        path, args = task
+        try:
+            func = funcs.get(path)
+            if func is None:
+                with lock_get_state(runtime):
+                    with ensure_stack_balance(runtime):
+                        runtime._pushvar(*path.split('.'))
+                        func = funcs[path] = runtime.pull(-1)
+            result = (True, _to_python(func(*args)))
+        except Exception as e:
+            result = (False, e)
+        tasks += 1
+        recycle = bool(max_tasks and tasks >= max_tasks or max_memory and _rss() > max_memory)
+        try:
+            conn.send(result + (recycle,))
+        except Exception as e:
+            conn.send((False, RuntimeError('cannot send result: {!r}'.format(e)), recycle))
+        if recycle:
+            break
+    conn.close()
+
+
+def _template_main(conn, prelude, runtime_kwargs):
+    """
+    The loop of the template process. It warms up a runtime once,
+    then forks a worker for each spawn request.
+    """
+    runtime = LuaRuntime(**runtime_kwargs)
+    if prelude is not None:
+        if callable(prelude):
+            prelude(runtime)
+        else:
+            runtime.execute(prelude)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            status = 0
+            try:
+                _worker_main(runtime, *request)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+
+
+class LuaProcessExecutor:
+    """
+    Run lua functions in a pool of worker processes.
+
+    A template process makes a runtime and runs ``prelude`` once.
+    Workers are forked from it, so each one starts with a warm runtime.
+    Tasks are lua function paths such as ``'mod.func'`` with picklable
+    arguments. Results come back as python objects, lua tables as dicts.
+
+    A worker is replaced after ``max_tasks_per_worker`` tasks, or when
+    its resident memory exceeds ``max_memory`` bytes.
+
+    Needs ``os.fork``, so it works on POSIX only.
+    """
+    def __init__(self, max_workers=None, prelude=None, *, max_tasks_per_worker=None,
+                 max_memory=None, **kwargs):
+        """
+        Init the executor, starting the template and the workers.
+
+        :param max_workers: number of workers. Default is the number of CPUs
+        :param prelude: lua code to execute, or a function called with
+            the runtime, in the template process
+        :param max_tasks_per_worker: recycle a worker after this many tasks
+        :param max_memory: recycle a worker when its RSS exceeds this many bytes
+        :param kwargs: passed to :py:class:`ffilupa.runtime.LuaRuntime`
+        """
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('LuaProcessExecutor needs os.fork')
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_memory = max_memory
+        self._tasks = queue.Queue()
+        self._spawn_lock = threading.Lock()
+        self._shutdown = False
+        ctx = multiprocessing.get_context('fork')
+        self._template_conn, child_conn = ctx.Pipe()
+        self._template = ctx.Process(target=_template_main, args=(child_conn, prelude, kwargs), daemon=True)
+        self._template.start()
+        child_conn.close()
+        self._authkey = os.urandom(32)
+        self._listener = Listener(authkey=self._authkey)
+        self._threads = [threading.Thread(target=self._serve, daemon=True) for _ in range(self.max_workers)]
+        for t in self._threads:
+            t.start()
+
+    def _spawn(self):
+        """ask the template to fork a worker and returns the connection to it"""
+        with self._spawn_lock:
+            self._template_conn.send((self._listener.address, self._authkey,
+                                      self.max_tasks_per_worker, self.max_memory))
+            return self._listener.accept()
+
+    def _serve(self):
+        """feed tasks to one worker at a time, respawning it when it's recycled"""
+        conn = None
+        try:
+            while True:
+                item = self._tasks.get()
+                if item is None:
+                    break
+                future, path, args = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if conn is None:
+                        conn = self._spawn()
+                    conn.send((path, args))
+                    ok, value, recycle = conn.recv()
+                except Exception as e:
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    future.set_exception(e)
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+                if recycle:
+                    conn.close()
+                    conn = None
+        finally:
+            if conn is not None:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+                conn.close()
+
+    def submit(self, path, *args):
+        """
+        Call the lua function at ``path`` in a worker with ``args``.
+        Returns a :py:class:`concurrent.futures.Future`.
+        """
+        if self._shutdown:
+            raise RuntimeError('cannot submit after shutdown')
+        future = Future()
+        self._tasks.put((future, path, args))
+        return future
+
+    def map(self, path, *iterables):
+        """Same as ``map``, but calls the lua function at ``path`` in workers."""
+        futures = [self.submit(path, *args) for args in zip(*iterables)]
+        return (f.result() for f in futures)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers and the template after the submitted tasks are done.
+        """
+        if self._shutdown:
+            return
+        self._shutdown = True
+        for _ in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+            with self._spawn_lock:
+                self._template_conn.send(None)
+            self._template.join()
+            self._template_conn.close()
+            self._listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
@@ -0,0 +1,440 @@
+"""module contains LuaGC, the control of the lua garbage collector"""
+
+
+__all__ = ('LuaGC', 'GCStats', 'IdleCollector')
+
+import gc
+import sys
+import threading
+import time
+import types
+from collections import namedtuple
+from .exception import *
+from .util import *
+from .py_from_lua import LuaLimitedObject, LuaVolatile
+
+
+GCStats = namedtuple('GCStats', ('kbytes', 'collections'))
+
+
+class LuaGC:
+    """
+    The garbage collector of a runtime, available as ``runtime.gc``.
+
+    Each method is a direct ``lua_gc`` call, so it's much cheaper than
+    running ``collectgarbage`` in lua. :py:meth:`collect` and
+    :py:meth:`step` may run ``__gc`` metamethods, so they're called in
+    protected mode and errors in the metamethods are raised as
+    :py:class:`ffilupa.exception.LuaErr`.
+    """
+    def __init__(self, runtime):
+        self._runtime = runtime
+        with lock_get_state(runtime) as L:
+            runtime.lib._gc_install(L)
+
+    def _gc(self, what, data=0):
+        with lock_get_state(self._runtime) as L:
+            return self._runtime.lib.lua_gc(L, what, data)
+
+    def _gc_protected(self, what, data=0):
+        runtime = self._runtime
+        lib = runtime.lib
+        with lock_get_state(runtime) as L:
+            with ensure_stack_balance(runtime):
+                result = runtime.ffi.new('int*')
+                status = lib._gc_protected(L, what, data, result)
+                if status != lib.LUA_OK:
+                    raise LuaErr.new(runtime, status, runtime.pull(-1), runtime.encoding)
+                return result[0]
+
+    def collect(self):
+        """Run a full garbage collection cycle."""
+        self._gc_protected(self._runtime.lib.LUA_GCCOLLECT)
+
+    def step(self, size=0):
+        """
+        Run an incremental step of garbage collection. A ``size`` of 0
+        runs one basic step, larger sizes run as if ``size`` KB were
+        allocated. Returns True if the step finished a cycle.
+        """
+        return bool(self._gc_protected(self._runtime.lib.LUA_GCSTEP, size))
+
+    def stop(self):
+        """Stop the garbage collector until :py:meth:`restart`."""
+        self._gc(self._runtime.lib.LUA_GCSTOP)
+
+    def restart(self):
+        """Restart the garbage collector."""
+        self._gc(self._runtime.lib.LUA_GCRESTART)
+
+    def isrunning(self):
+        """Returns whether the garbage collector is running."""
+        return bool(self._gc(self._runtime.lib.LUA_GCISRUNNING))
+
+    def setpause(self, pause):
+        """
+        Set the pause of the collector, in percent, and returns the
+        previous value. The collector waits for the memory in use to
+        grow by this percent before starting a new cycle.
+        """
+        return self._gc(self._runtime.lib.LUA_GCSETPAUSE, pause)
+
+    def setstepmul(self, stepmul):
+        """
+        Set the step multiplier of the collector, in percent, and
+        returns the previous value. It controls the speed of the
+        collector relative to memory allocation.
+        """
+        return self._gc(self._runtime.lib.LUA_GCSETSTEPMUL, stepmul)
+
+    def _mode(self, name):
+        what = getattr(self._runtime.lib, name, None)
+        if what is None:
+            raise NotImplementedError('lua {} has no generational mode'.format(self._runtime.lualib.version))
+        self._gc(what)
+
+    def generational(self):
+        """
+        Switch the collector to generational mode.
+        Raises NotImplementedError if the lua version doesn't support it.
+        """
+        self._mode('LUA_GCGEN')
+
+    def incremental(self):
+        """
+        Switch the collector to incremental mode.
+        Raises NotImplementedError if the lua version doesn't support
+        the generational mode.
+        """
+        self._mode('LUA_GCINC')
+
+    @property
+    def supports_generational(self):
+        """Whether the lua version supports the generational mode."""
+        return hasattr(self._runtime.lib, 'LUA_GCGEN')
+
+    def count(self):
+        """Returns the memory in use by lua in KB, as a float."""
+        with lock_get_state(self._runtime) as L:
+            lib = self._runtime.lib
+            return lib.lua_gc(L, lib.LUA_GCCOUNT, 0) + lib.lua_gc(L, lib.LUA_GCCOUNTB, 0) / 1024
+
+    def stats(self):
+        """
+        Returns a :py:class:`GCStats` with the memory in use in KB,
+        and the number of collection cycles finished since the
+        runtime was made.
+        """
+        with lock_get_state(self._runtime) as L:
+            return GCStats(self.count(), self._runtime.lib._gc_cycles(L))
+
+    def collect_cycles(self):
+        """
+        Find and break reference cycles crossing python and lua.
+
+        A python object pushed into lua is pinned by its handle in
+        ``runtime.refs`` until the lua userdata is collected, and a
+        lua object wrapper pins its lua value by a registry ref, so a
+        cycle through both heaps is never collected by either
+        collector. This traces lua from its registry and python from
+        the objects outside of the pinned ones, across the handles and
+        the wrappers. Wrappers which are unreachable from both are
+        released, and turn into wrappers of nil. Then a full lua
+        collection frees the userdata and unpins the python objects,
+        which are left to the python collector.
+
+        It walks all python objects reachable from the pinned ones, so
+        it's as expensive as a full ``gc.collect``. It can't be called
+        while lua is running in the runtime. Returns the number of
+        wrappers released.
+        """
+        released = _CycleCollector(self._runtime).run()
+        if released:
+            self.collect()
+        return released
+
+    def idle(self, **kwargs):
+        """Returns an :py:class:`IdleCollector` of the runtime made with ``kwargs``."""
+        return IdleCollector(self._runtime, **kwargs)
+
+
+class IdleCollector:
+    """
+    Run incremental garbage collection steps of a runtime while it's idle,
+    to move collection work off the calls into lua.
+
+    Steps are taken on ticks, every ``interval`` seconds, either from an
+    asyncio loop (:py:meth:`attach`) or from a background thread
+    (:py:meth:`start`). A tick only runs if the runtime lock is free
+    at that moment, otherwise it's skipped. It steps the collector
+    until a cycle finishes or ``step_time`` seconds pass. After a cycle
+    finishes, a new one is only started once the memory in use grows
+    by ``growth`` of what it was at the end of the cycle.
+
+    While active, the pause of the collector is raised to ``pause``, so
+    the automatic collection during calls runs less often. The old
+    pause is restored by :py:meth:`stop`.
+    """
+    def __init__(self, runtime, *, interval=0.05, step_time=0.002, step_size=0, pause=400,
+                 growth=0.2):
+        """
+        Init an idle collector. It's not active until it's started or attached.
+
+        :param interval: seconds between two ticks
+        :param step_time: seconds of collection work per tick at most
+        :param step_size: the ``size`` of each :py:meth:`LuaGC.step`
+        :param pause: the pause of the collector while active, in percent
+        :param growth: fraction the memory in use must grow by before
+            the next idle cycle starts
+        """
+        self._runtime = runtime
+        self.interval = interval
+        self.step_time = step_time
+        self.step_size = step_size
+        self.pause = pause
+        self.growth = growth
+        self._baseline = None
+        self.steps = self.ticks = self.skipped = 0
+        self.busy_time = 0.0
+        self.last_error = None
+        self._old_pause = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._loop = self._handle = None
+
+    @property
+    def active(self):
+        """Whether the collector is started or attached."""
+        return self._old_pause is not None
+
+    def _activate(self):
+        if self.active:
+            raise RuntimeError('the idle collector is already active')
+        self._old_pause = self._runtime.gc.setpause(self.pause)
+
+    def tick(self):
+        """
+        Run one tick now. Returns False if the runtime was busy and
+        the tick was skipped.
+        """
+        lock = self._runtime._lock
+        if not lock.acquire(False):
+            self.skipped += 1
+            return False
+        try:
+            gc = self._runtime.gc
+            if self._baseline is not None:
+                if gc.count() < self._baseline * (1 + self.growth):
+                    return True
+                self._baseline = None
+            start = time.monotonic()
+            deadline = start + self.step_time
+            self.ticks += 1
+            while True:
+                self.steps += 1
+                try:
+                    if gc.step(self.step_size):
+                        self._baseline = gc.count()
+                        break
+                except LuaErr as e:
+                    self.last_error = e
+                    break
+                if time.monotonic() >= deadline:
+                    break
+            self.busy_time += time.monotonic() - start
+            return True
+        finally:
+            lock.release()
+
+    def start(self):
+        """
+        Start a daemon thread ticking every ``interval`` seconds.
+        The runtime must be thread-safe.
+        """
+        from .runtime import ConfinedLock
+        if isinstance(self._runtime._lock, ConfinedLock):
+            raise ValueError('cannot collect a thread-confined runtime from another thread')
+        self._activate()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.tick()
+
+    def attach(self, loop=None):
+        """
+        Tick every ``interval`` seconds in the asyncio ``loop``.
+        Default is the running loop, or the current loop.
+        """
+        import asyncio
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = asyncio.get_event_loop()
+        self._activate()
+        self._loop = loop
+        self._handle = loop.call_later(self.interval, self._loop_tick)
+
+    def _loop_tick(self):
+        self.tick()
+        if self._loop is not None:
+            self._handle = self._loop.call_later(self.interval, self._loop_tick)
+
+    def stop(self):
+        """Stop ticking and restore the pause of the collector."""
+        if not self.active:
+            return
+        if self._thread is not None:
+            self._stopping.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+        if self._loop is not None:
+            self._handle.cancel()
+            self._loop = self._handle = None
+        self._runtime.gc.setpause(self._old_pause)
+        self._old_pause = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class _CycleCollector:
+    """the state of one run of :py:meth:`LuaGC.collect_cycles`"""
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.nodes = {}
+        self.wrappers = {}
+        self.marked = set()
+        self.pending = []
+
+    def run(self):
+        runtime = self.runtime
+        lib = runtime.lib
+        with lock_get_state(runtime) as L:
+            if lib.lua_gettop(L) or lib.lua_getstack(L, 0, runtime.ffi.new('lua_Debug*')):
+                raise RuntimeError('cannot collect cycles while lua is running')
+            runtime._drain_release_queue()
+            pinned = self._trace_python()
+            if not self.wrappers:
+                return 0
+            self._mark_python([k for k, n in self._external_refs(pinned).items() if n > 0])
+            with ensure_stack_balance(runtime):
+                self._mark_lua(L)
+            garbage = [w for k, w in self.wrappers.items() if k not in self.marked]
+            refs = [w._ref for w in garbage]
+            for w in garbage:
+                w._ref = lib.LUA_NOREF
+            lib._unref_many(L, refs, len(refs))
+            return len(garbage)
+
+    def _trace_python(self):
+        """collect python objects reachable from the pinned ones, stopping at wrappers"""
+        runtime = self.runtime
+        ffi = runtime.ffi
+        pinned = {}
+        work = []
+        for handle in list(runtime.refs):
+            work.append(ffi.from_handle(handle))
+            pinned[id(work[-1])] = pinned.get(id(work[-1]), 0) + 1
+        stop = {id(runtime), id(runtime.refs), id(runtime.__dict__)}
+        stop.update(id(vars(m)) for m in list(sys.modules.values()) if isinstance(m, types.ModuleType))
+        nodes, wrappers = self.nodes, self.wrappers
+        while work:
+            x = work.pop()
+            k = id(x)
+            if k in nodes or k in stop or not gc.is_tracked(x) or isinstance(x, (type, types.ModuleType)):
+                continue
+            nodes[k] = x
+            if isinstance(x, LuaLimitedObject):
+                if x._runtime is runtime and not isinstance(x, LuaVolatile):
+                    wrappers[k] = x
+                continue
+            work.extend(gc.get_referents(x))
+        return pinned
+
+    def _external_refs(self, pinned):
+        """
+        Count references to each node from outside the nodes, like the
+        python collector does. Handles in ``runtime.refs`` and the
+        bookkeeping of this collector don't count.
+        """
+        nodes, wrappers = self.nodes, self.wrappers
+        probe = []
+        nodes[id(probe)] = probe
+        internal = dict.fromkeys(nodes, 0)
+        for k, x in nodes.items():
+            if k in wrappers:
+                continue
+            for y in gc.get_referents(x):
+                if id(y) in internal:
+                    internal[id(y)] += 1
+        external = {}
+        for k, x in nodes.items():
+            external[k] = sys.getrefcount(x) - internal[k] - pinned.get(k, 0) - (k in wrappers)
+        del x
+        # the probe is only referred to by the local variable
+        offset = external.pop(id(probe)) - 1
+        del nodes[id(probe)]
+        return {k: n - offset for k, n in external.items()}
+
+    def _mark_python(self, keys):
+        nodes, marked = self.nodes, self.marked
+        work = [k for k in keys if k in nodes and k not in marked]
+        marked.update(work)
+        while work:
+            k = work.pop()
+            if k in self.wrappers:
+                self.pending.append(self.wrappers[k])
+                continue
+            for y in gc.get_referents(nodes[k]):
+                ky = id(y)
+                if ky in nodes and ky not in marked:
+                    marked.add(ky)
+                    work.append(ky)
+
+    def _mark_lua(self, L):
+        """mark lua from the registry and the marked wrappers, until nothing new is marked"""
+        from .metatable import PYOBJ_SIG
+        runtime = self.runtime
+        lib, ffi = runtime.lib, runtime.ffi
+        lib.lua_newtable(L)
+        lib.lua_newtable(L)
+        lib.luaL_getmetatable(L, PYOBJ_SIG)
+        lib.lua_newtable(L)
+        for w in self.wrappers.values():
+            lib.lua_pushboolean(L, 1)
+            lib.lua_rawseti(L, -2, w._ref)
+        found = 0
+        roots = 1
+        lib.lua_pushvalue(L, lib.LUA_REGISTRYINDEX)
+        while True:
+            for w in self.pending:
+                w._pushobj()
+            roots += len(self.pending)
+            del self.pending[:]
+            for i in range(4):
+                lib.lua_pushvalue(L, -roots - 4)
+                lib.lua_insert(L, -roots - 1)
+            status = lib._cycle_mark(L, roots + 4)
+            if status != lib.LUA_OK:
+                raise LuaErr.new(runtime, status, runtime.pull(-1), runtime.encoding)
+            total = lib.lua_rawlen(L, -3)
+            if total == found:
+                break
+            keys = []
+            for i in range(found + 1, total + 1):
+                lib.lua_rawgeti(L, -3, i)
+                keys.append(id(ffi.from_handle(ffi.cast('void**', lib.lua_touserdata(L, -1))[0])))
+                lib.lua_pop(L, 1)
+            found = total
+            self._mark_python(keys)
+            if not self.pending:
+                break
+            roots = 0
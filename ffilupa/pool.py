@@ -0,0 +1,195 @@
+"""module contains LuaRuntimePool, a pool of pre-warmed lua runtimes"""
+
+
+__all__ = ('LuaRuntimePool', 'PoolStats')
+
+import queue
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from .runtime import LuaRuntime
+
+
+PoolStats = namedtuple('PoolStats', ('size', 'idle', 'checkouts', 'resets', 'replaced',
+                                     'wait_time', 'max_wait', 'utilization'))
+
+
+_snapshot_code = '''
+local G = _G
+local next, rawget, rawset, rawequal, type = next, rawget, rawset, rawequal, type
+local function copy(t)
+    local c = {}
+    for k, v in next, t do
+        c[k] = v
+    end
+    return c
+end
+local function restore(t, c)
+    for k in next, t do
+        if rawget(c, k) == nil then
+            rawset(t, k, nil)
+        end
+    end
+    for k, v in next, c do
+        if not rawequal(rawget(t, k), v) then
+            rawset(t, k, v)
+        end
+    end
+end
+local snapshot, fields = copy(G), {}
+for _, v in next, snapshot do
+    if type(v) == 'table' and not rawequal(v, G) then
+        fields[v] = copy(v)
+    end
+end
+local loaded = type(G.package) == 'table' and rawget(G.package, 'loaded')
+if type(loaded) == 'table' then
+    fields[loaded] = copy(loaded)
+end
+return function()
+    restore(G, snapshot)
+    for t, c in next, fields do
+        restore(t, c)
+    end
+end
+'''
+
+
+class LuaRuntimePool:
+    """
+    A fixed size pool of lua runtimes.
+
+    Each runtime is made and warmed up once by running ``prelude``.
+    Then the globals, the fields of tables directly in the globals
+    (such as ``string``) and ``package.loaded`` are snapshotted. When
+    a runtime is checked in, they are restored to the snapshot.
+    Changes deeper than that are not undone.
+
+    The pool is thread-safe. Each runtime is used by one thread at a time.
+    """
+    def __init__(self, size, prelude=None, *, reset=True, **kwargs):
+        """
+        Init the pool and make ``size`` runtimes.
+
+        :param prelude: lua code to execute, or a function called with
+            the runtime, to warm up each runtime
+        :param reset: whether to restore the globals on check-in
+        :param kwargs: passed to :py:class:`ffilupa.runtime.LuaRuntime`
+        """
+        self.size = size
+        self.prelude = prelude
+        self.reset = reset
+        self._kwargs = kwargs
+        self._idle = queue.Queue()
+        self._restorers = {}
+        self._checkout_times = {}
+        self._stats_lock = threading.Lock()
+        self._checkouts = self._resets = self._replaced = 0
+        self._wait_time = self._max_wait = self._busy_time = 0.0
+        self._created = time.monotonic()
+        self._closed = False
+        for _ in range(size):
+            self._idle.put(self._make())
+
+    def _make(self):
+        """make and warm up a runtime"""
+        runtime = LuaRuntime(**self._kwargs)
+        if self.prelude is not None:
+            if callable(self.prelude):
+                self.prelude(runtime)
+            else:
+                runtime.execute(self.prelude)
+        if self.reset:
+            self._restorers[runtime] = runtime.execute(_snapshot_code)
+        return runtime
+
+    def acquire(self, timeout=None):
+        """
+        Take an idle runtime out of the pool, waiting at most ``timeout``
+        seconds. Raises TimeoutError if there's no idle runtime in time.
+        The runtime must be given back by :py:meth:`release`.
+        """
+        if self._closed:
+            raise RuntimeError('the pool is closed')
+        start = time.monotonic()
+        try:
+            runtime = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('no idle runtime in {} seconds'.format(timeout)) from None
+        now = time.monotonic()
+        with self._stats_lock:
+            self._checkouts += 1
+            self._wait_time += now - start
+            self._max_wait = max(self._max_wait, now - start)
+            self._checkout_times[runtime] = now
+        return runtime
+
+    def release(self, runtime):
+        """
+        Give back ``runtime`` to the pool, restoring its globals.
+        If restoring fails, the runtime is replaced with a new one.
+        """
+        with self._stats_lock:
+            self._busy_time += time.monotonic() - self._checkout_times.pop(runtime)
+        if self._closed:
+            self._restorers.pop(runtime, None)
+            runtime.close()
+            return
+        if self.reset:
+            try:
+                self._restorers[runtime]()
+            except Exception:
+                del self._restorers[runtime]
+                runtime.close()
+                runtime = self._make()
+                with self._stats_lock:
+                    self._replaced += 1
+            else:
+                with self._stats_lock:
+                    self._resets += 1
+        self._idle.put(runtime)
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """
+        A context manager. Take an idle runtime and give it back at exit.
+        See :py:meth:`acquire`.
+        """
+        runtime = self.acquire(timeout)
+        try:
+            yield runtime
+        finally:
+            self.release(runtime)
+
+    def stats(self):
+        """
+        Returns a :py:class:`PoolStats`. ``wait_time`` is the total seconds
+        spent waiting in :py:meth:`acquire`. ``utilization`` is the fraction
+        of runtime-seconds spent checked out since the pool was made.
+        """
+        with self._stats_lock:
+            elapsed = (time.monotonic() - self._created) * self.size
+            return PoolStats(self.size, self._idle.qsize(), self._checkouts, self._resets,
+                             self._replaced, self._wait_time, self._max_wait,
+                             self._busy_time / elapsed if elapsed else 0.0)
+
+    def close(self):
+        """
+        Close the idle runtimes. Runtimes checked out are closed
+        when they're released.
+        """
+        self._closed = True
+        while True:
+            try:
+                runtime = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._restorers.pop(runtime, None)
+            runtime.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -75,15 +75,10 @@ class LuaLimitedObject(NotCopyable):
 
     def _ref_to_index(self, runtime, index):
         lib = runtime.lib
-        ffi = runtime.ffi
         with lock_get_state(runtime) as L:
             with assert_stack_balance(runtime):
-                index = lib.lua_absindex(L, index)
-                key = ffi.new('char*')
-                lib.lua_pushlightuserdata(L, key)
                 lib.lua_pushvalue(L, index)
-                lib.lua_rawset(L, lib.LUA_REGISTRYINDEX)
-                self._ref_to_key(key)
+                self._ref_to_key(lib.luaL_ref(L, lib.LUA_REGISTRYINDEX))
 
     def __init__(self, runtime, index):
         """
@@ -128,23 +123,19 @@ class LuaLimitedObject(NotCopyable):
             }[tp](runtime, index)
 
     def __del__(self):
-        """unregister the lua object."""
-        key = self._ref
-        lib = self._runtime.lib
-        with lock_get_state(self._runtime) as L:
-            if L:
-                with assert_stack_balance(self._runtime):
-                    lib.lua_pushlightuserdata(L, key)
-                    lib.lua_pushnil(L)
-                    lib.lua_rawset(L, lib.LUA_REGISTRYINDEX)
+        """
+        unregister the lua object.
+
+        The ref is only queued here. The runtime releases
+        queued refs in bulk, so this never waits for the lock.
+        """
+        self._runtime._release(self._ref)
 
     def _pushobj(self):
         """push the lua object onto the top of stack."""
-        key = self._ref
         lib = self._runtime.lib
         with lock_get_state(self._runtime) as L:
-            lib.lua_pushlightuserdata(L, key)
-            lib.lua_rawget(L, lib.LUA_REGISTRYINDEX)
+            lib.lua_rawgeti(L, lib.LUA_REGISTRYINDEX, self._ref)
 
     def __bool__(self):
         """convert to bool using lua_toboolean."""
@@ -395,24 +386,45 @@ class LuaCallable(LuaObject):
         ``*args`` will be "pushed" to lua and as the
         arguments to call the lua object.
         Keyword arguments will be processed in python.
+
+        ``instruction_limit`` and ``time_limit`` (in seconds) limit the
+        call. They default to the runtime's limits. If the call runs out
+        of them, :py:class:`ffilupa.exception.LuaErrBudget` is raised.
+
+        ``deep_push`` and ``deep_push_limit`` override the runtime's
+        options of pushing dicts, lists and tuples as lua tables.
         """
         lib = self._runtime.lib
         set_metatable = kwargs.pop('set_metatable', True)
+        push_kwargs = {k: kwargs.pop(k) for k in ('deep_push', 'deep_push_limit') if k in kwargs}
+        instruction_limit = kwargs.pop('instruction_limit', None)
+        time_limit = kwargs.pop('time_limit', None)
+        if instruction_limit is None:
+            instruction_limit = self._runtime.instruction_limit
+        if time_limit is None:
+            time_limit = self._runtime.time_limit
         with lock_get_state(self._runtime) as L:
             with ensure_stack_balance(self._runtime):
                 oldtop = lib.lua_gettop(L)
-                try:
-                    self._runtime._pushvar(b'debug', b'traceback')
-                    if lib.lua_isfunction(L, -1) or hasmetafield(self._runtime, -1, b'__call'):
-                        errfunc = 1
-                    else:
-                        lib.lua_pop(L, 1)
-                        errfunc = 0
-                except TypeError:
-                    errfunc = 0
                 self._pushobj()
-                handles = [self._runtime.push(obj, set_metatable=set_metatable) for obj in args]
-                status = lib.lua_pcall(L, len(args), lib.LUA_MULTRET, (-len(args) - 2) * errfunc)
+                handles = self._runtime.push_many(args, set_metatable=set_metatable, **push_kwargs)
+                alloc_stats = self._runtime._alloc_stats
+                failures = alloc_stats.failures if alloc_stats is not None else 0
+                if instruction_limit is None and time_limit is None:
+                    status = lib._pcall(L, len(args))
+                else:
+                    budget = self._runtime.ffi.new('_budget*')
+                    budget.instructions = -1 if instruction_limit is None else instruction_limit
+                    budget.step = self._runtime.budget_step
+                    lib._budget_begin(L, budget, time_limit or 0)
+                    try:
+                        status = lib._pcall(L, len(args))
+                    finally:
+                        lib._budget_end(L, budget)
+                    if budget.exceeded:
+                        self._runtime._clear_exception()
+                        raise LuaErrBudget(lib.LUA_ERRRUN, 'instruction limit exceeded'
+                                           if budget.exceeded == 1 else 'time limit exceeded')
                 if status != lib.LUA_OK:
                     err_msg = self._runtime.pull(-1)
                     try:
@@ -423,9 +435,12 @@ class LuaCallable(LuaObject):
                         if err_msg is stored:
                             self._runtime._reraise_exception()
                     self._runtime._clear_exception()
+                    if alloc_stats is not None and alloc_stats.failures != failures:
+                        # lauxlib reports some failed allocations as runtime errors
+                        status = lib.LUA_ERRMEM
                     raise LuaErr.new(self._runtime, status, err_msg, self._runtime.encoding)
                 else:
-                    rv = [self._runtime.pull(i, **kwargs) for i in range(oldtop + 1 + errfunc, lib.lua_gettop(L) + 1)]
+                    rv = self._runtime.pull_range(oldtop + 1, lib.lua_gettop(L) + 1, **kwargs)
                     if len(rv) > 1:
                         return tuple(rv)
                     elif len(rv) == 1:
@@ -512,6 +527,145 @@ class LuaTable(LuaCollection):
     Lua table type wrapper.
     """
 
+    def to_python(self, deep=True, *, max_depth=100, sequence=list, keys=None,
+                  on_cycle='error', autodecode=None, on_object=None):
+        """
+        Convert the table into python dicts and lists in one pass.
+
+        The nested tables are walked raw in C, ignoring metamethods.
+        A table whose keys are exactly ``1..n`` becomes a sequence,
+        other tables become dicts. A table appearing more than once
+        is converted once and the result is shared. Values which have
+        no by-value puller, such as functions, and tables used as keys
+        are pulled as usual.
+
+        :param deep: if false, only the table itself is converted
+            and nested tables are left as :py:class:`LuaTable`
+        :param max_depth: tables nested deeper than this are left
+            as :py:class:`LuaTable`
+        :param sequence: ``list``, ``tuple`` or another callable taking a
+            list, to make sequences. None to convert every table into a dict
+        :param keys: how to pull string keys. ``'str'`` decodes them,
+            ``'bytes'`` keeps them bytes, ``'auto'`` decodes them if they
+            are valid in the encoding. None pulls them like the values
+        :param on_cycle: what to do when a table contains itself.
+            ``'error'`` raises ValueError, ``'share'`` puts the list or dict
+            being built, ``'wrap'`` puts a :py:class:`LuaTable` and
+            ``'none'`` puts None
+        :param autodecode: whether to decode string values. Default
+            is the runtime's
+        :param on_object: a function called with each value pulled
+            as usual, whose return value is used instead
+        """
+        if on_cycle not in ('error', 'share', 'wrap', 'none'):
+            raise ValueError('unknown on_cycle {!r}'.format(on_cycle))
+        if keys not in (None, 'str', 'bytes', 'auto'):
+            raise ValueError('unknown keys {!r}'.format(keys))
+        runtime = self._runtime
+        lib, ffi = runtime.lib, runtime.ffi
+        pullers = runtime._puller._get_table(lib)
+        state = ffi.new('_walk_state*')
+        state.maxdepth = max_depth if deep else min(max_depth, 1)
+        state.mask = sum(1 << t for t in range(lib.LUA_NUMTAGS) if pullers[t][1])
+        state.sequences = sequence is not None
+        state.wrapcycles = on_cycle == 'wrap'
+        cap = 256
+        with lock_get_state(runtime) as L:
+            with ensure_stack_balance(runtime):
+                while True:
+                    records = ffi.new('_stack_value[]', cap)
+                    state.out, state.cap, state.n, state.tables = records, cap, 0, 0
+                    self._pushobj()
+                    status = lib._walk(L, state)
+                    if status != lib.LUA_OK:
+                        raise LuaErr.new(runtime, status, runtime.pull(-1), runtime.encoding)
+                    if state.n <= cap:
+                        break
+                    cap = state.n
+                    lib.lua_pop(L, 1)
+                return _TableBuilder(runtime, L, records, pullers, sequence, keys, on_cycle,
+                                     autodecode, on_object).value()
+
+
+class _TableBuilder:
+    """
+    Build python objects from the records written by the C walk of
+    :py:meth:`LuaTable.to_python`. The table of the other objects must
+    be at the top of the lua stack.
+    """
+    def __init__(self, runtime, L, records, pullers, sequence, keys, on_cycle, autodecode, on_object):
+        self.runtime = runtime
+        self.L = L
+        self.records = records
+        self.pos = 0
+        self.pullers = pullers
+        self.sequence = sequence
+        self.keys = keys
+        self.on_cycle = on_cycle
+        self.autodecode = autodecode
+        self.on_object = on_object
+        self.tables = {}
+        lib = runtime.lib
+        self.tobject, self.ttable, self.tstring = lib._WALK_OBJECT, lib.LUA_TTABLE, lib.LUA_TSTRING
+
+    def value(self, autodecode=None):
+        r = self.records[self.pos]
+        self.pos += 1
+        tp = r.type
+        if tp == self.tobject:
+            lib = self.runtime.lib
+            lib.lua_rawgeti(self.L, -1, r.integer)
+            try:
+                rv = self.runtime.pull(-1, autodecode=self.autodecode if autodecode is None else autodecode)
+            finally:
+                lib.lua_pop(self.L, 1)
+            return rv if self.on_object is None else self.on_object(rv)
+        if tp == self.ttable:
+            return self.table(r)
+        return self.pullers[tp][0](self.runtime, r, autodecode=self.autodecode if autodecode is None else autodecode)
+
+    def key(self):
+        keys = self.keys
+        if keys is None:
+            return self.value()
+        elif keys == 'auto':
+            r = self.records[self.pos]
+            if r.type == self.tstring:
+                self.pos += 1
+                s = self.runtime.ffi.unpack(r.string, r.length)
+                try:
+                    return s.decode(self.runtime.encoding)
+                except (UnicodeDecodeError, TypeError):
+                    return s
+            return self.value()
+        else:
+            return self.value(keys == 'str')
+
+    def table(self, r):
+        flags, id = r.isinteger, r.integer
+        tables = self.tables
+        lib = self.runtime.lib
+        if flags & lib._WALK_OPEN:
+            if self.on_cycle == 'none':
+                return None
+            if self.on_cycle == 'share' and isinstance(tables[id], (list, dict)):
+                return tables[id]
+            raise ValueError('the table contains itself')
+        if flags & lib._WALK_SEEN:
+            return tables[id]
+        if flags & lib._WALK_ARRAY:
+            rv = tables[id] = []
+            for _ in range(r.length):
+                rv.append(self.value())
+            if self.sequence is not list:
+                rv = tables[id] = self.sequence(rv)
+        else:
+            rv = tables[id] = {}
+            for _ in range(r.length):
+                k = self.key()
+                rv[k] = self.value()
+        return rv
+
 
 class LuaFunction(LuaCallable):
     """
@@ -648,6 +802,19 @@ class LuaThread(LuaObject, Generator):
             finally:
                 self._runtime._G.debug.sethook(self)
 
+    def __await__(self):
+        """
+        Run the lua coroutine in asyncio, awaiting the python
+        awaitables it yields. See :py:func:`ffilupa.aio.drive`.
+        """
+        from .aio import drive
+        return drive(self).__await__()
+
+    def __aiter__(self):
+        """Iterate asynchronously. See :py:func:`ffilupa.aio.iterate`."""
+        from .aio import iterate
+        return iterate(self)
+
 
 
 class LuaUserdata(LuaCollection, LuaCallable):
@@ -729,17 +896,85 @@ class LuaIter(Iterator):
     """
     Base class of Iterator classes for LuaCollection.
 
-    At init, lua function ``pairs`` will be called and
-    iteration will be just like a "for in" in lua.
+    A plain table is iterated with raw ``lua_next``, fetching
+    ``batch_size`` pairs each time the lua state is entered.
+    Tables with a ``__pairs`` metamethod and other objects are
+    iterated with lua function ``pairs``, called at init, just
+    like a "for in" in lua.
     """
-    def __init__(self, obj):
+
+    #: how many pairs are fetched at once when iterating a plain table
+    batch_size = 256
+
+    def __init__(self, obj, batch_size=None):
         """
         Init self with ``obj``, a LuaCollection object.
         """
         super().__init__()
-        self._info = list(obj._runtime._G.pairs(obj, keep=True))
+        runtime = obj._runtime
+        lib = runtime.lib
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self._batch = iter(())
+        self._obj = obj
+        self._key = None
+        self._info = None
+        with lock_get_state(runtime) as L:
+            with ensure_stack_balance(runtime):
+                obj._pushobj()
+                if lib.lua_type(L, -1) == lib.LUA_TTABLE and not hasmetafield(runtime, -1, b'__pairs'):
+                    return
+        self._info = list(runtime._G.pairs(obj, keep=True))
 
     def __next__(self):
+        try:
+            return next(self._batch)
+        except StopIteration:
+            pass
+        if self._info is not None:
+            return self._next_pairs()
+        obj = self._obj
+        if obj is None:
+            raise StopIteration
+        with obj._runtime.lock():
+            # another thread may have fetched the batch meanwhile
+            try:
+                return next(self._batch)
+            except StopIteration:
+                pass
+            if self._obj is None:
+                raise StopIteration
+            self._fill()
+            return next(self._batch)
+
+    def _fill(self):
+        """fetch the next batch of pairs with raw ``lua_next``"""
+        obj = self._obj
+        runtime = obj._runtime
+        lib = runtime.lib
+        n = self.batch_size
+        with lock_get_state(runtime) as L:
+            with ensure_stack_balance(runtime):
+                base = lib.lua_gettop(L)
+                obj._pushobj()
+                if self._key is None:
+                    lib.lua_pushnil(L)
+                else:
+                    self._key._pushobj()
+                status = lib._next_batch(L, n)
+                if status != lib.LUA_OK:
+                    raise LuaErr.new(runtime, status, runtime.pull(-1), runtime.encoding)
+                top = lib.lua_gettop(L)
+                if top - base < 2 * n:
+                    self._obj = self._key = None
+                else:
+                    self._key = LuaVolatile(runtime, top - 1).settle()
+                values = runtime.pull_range(base + 1, top + 1)
+        filterkv = self._filterkv
+        self._batch = iter([filterkv(values[i], values[i + 1]) for i in range(0, len(values), 2)])
+
+    def _next_pairs(self):
+        """step with the ``next`` function returned by ``pairs``"""
         _, obj, _ = self._info
         with obj._runtime.lock():
             func, obj, index = self._info
@@ -787,52 +1022,130 @@ class Puller(Registry):
     def __init__(self):
         super().__init__()
         self._default_puller = None
+        self._tables = {}
 
     def __call__(self, runtime, index, *, keep=False, **kwargs):
         """Pull the lua object at ``index`` into python"""
+        if keep:
+            return LuaVolatile(runtime, index).settle()
         lib = runtime.lib
-        obj = LuaVolatile(runtime, index)
+        table = self._get_table(lib)
+        with lock_get_state(runtime) as L:
+            value = runtime._peek_buffer
+            func, by_value = table[lib._peek_value(L, index, value)]
+            if by_value:
+                return func(runtime, value, **kwargs)
+            return func(runtime, LuaVolatile(runtime, index), **kwargs)
+
+    def pull_range(self, runtime, start, stop, *, keep=False, **kwargs):
+        """
+        Pull the lua objects from absolute index ``start`` up to
+        but not including ``stop`` and returns them in a list.
+        The whole range is peeked in one call.
+        """
         if keep:
-            return obj.settle()
-        tp = obj._type()
-        return self._find_puller(lib, tp)(runtime, obj, **kwargs)
+            return [LuaVolatile(runtime, i).settle() for i in range(start, stop)]
+        n = stop - start
+        if n <= 0:
+            return []
+        lib = runtime.lib
+        table = self._get_table(lib)
+        with lock_get_state(runtime) as L:
+            values = runtime.ffi.new('_stack_value[]', n)
+            lib._peek_values(L, start, n, values)
+            rv = []
+            for i in range(n):
+                value = values[i]
+                func, by_value = table[value.type]
+                if by_value:
+                    rv.append(func(runtime, value, **kwargs))
+                else:
+                    rv.append(func(runtime, LuaVolatile(runtime, start + i), **kwargs))
+            return rv
+
+    def _get_table(self, lib):
+        try:
+            return self._tables[lib]
+        except KeyError:
+            return self._build_table(lib)
 
-    def _find_puller(self, lib, tp):
+    def _build_table(self, lib):
+        """
+        Build the dispatch table of ``lib``, indexed by lua type.
+        The last slot is for ``LUA_TNONE``, which is -1.
+        """
+        table = [self._default_puller or self._no_puller] * (lib.LUA_NUMTAGS + 1)
         for k, v in self.items():
-            if getattr(lib, k) == tp:
-                return v
-        if self._default_puller is not None: return self._default_puller
-        raise TypeError('cannot find puller for lua type \'' + str(tp) + '\'')
+            table[getattr(lib, k)] = v
+        table = [(func, getattr(func, 'pull_by_value', False)) for func in table]
+        self._tables[lib] = table
+        return table
+
+    def register(self, name, *, by_value=False):
+        """
+        A decorator. Register a puller for lua type ``name``.
+
+        If ``by_value`` is true, the puller receives the ``_stack_value``
+        peeked from the lua stack instead of a :py:class:`LuaVolatile`.
+        The payload is only valid while the puller runs.
+        """
+        def _(func):
+            if by_value:
+                func.pull_by_value = True
+            self[name] = func
+            return func
+        return _
+
+    @staticmethod
+    def _no_puller(runtime, obj, **kwargs):
+        raise TypeError('cannot find puller for lua type \'' + str(obj._type()) + '\'')
 
     def register_default(self, func):
         """register default puller"""
         self._default_puller = func
+        self._tables = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._tables = {}
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._tables = {}
+
+    def copy(self):
+        o = self.__class__()
+        o.update(self)
+        o.register_default(self._default_puller)
+        return o
 
 std_puller = Puller()
 
-@std_puller.register('LUA_TNIL')
-def _(runtime, obj, **kwargs):
+@std_puller.register('LUA_TNIL', by_value=True)
+def _(runtime, value, **kwargs):
     return None
 
-@std_puller.register('LUA_TNUMBER')
-def _(runtime, obj, **kwargs):
-    try:
-        i = LuaNumber.__int__(obj)
-        f = LuaNumber.__float__(obj)
+@std_puller.register('LUA_TNUMBER', by_value=True)
+def _(runtime, value, **kwargs):
+    f = value.number
+    if value.isinteger:
+        i = value.integer
         return i if i == f else f
-    except TypeError:
-        return LuaNumber.__float__(obj)
+    return f
 
-@std_puller.register('LUA_TBOOLEAN')
-def _(runtime, obj, **kwargs):
-    return LuaBoolean.__bool__(obj)
+@std_puller.register('LUA_TBOOLEAN', by_value=True)
+def _(runtime, value, **kwargs):
+    return bool(value.integer)
 
-@std_puller.register('LUA_TSTRING')
-def _(runtime, obj, *, autodecode=None, **kwargs):
+@std_puller.register('LUA_TSTRING', by_value=True)
+def _(runtime, value, *, autodecode=None, **kwargs):
+    s = runtime.ffi.unpack(value.string, value.length)
     if (runtime.autodecode if autodecode is None else autodecode):
-        return LuaString.__str__(obj)
+        if runtime.encoding is None:
+            raise ValueError('encoding not specified')
+        return s.decode(runtime.encoding)
     else:
-        return LuaString.__bytes__(obj)
+        return s
 
 @std_puller.register_default
 def _(runtime, obj, *, autounpack=True, keep_handle=False, **kwargs):
@@ -7,6 +7,7 @@ import functools
 from collections import namedtuple
 
 from .protocol import *
+from .exception import LuaErrMem
 from .py_from_lua import LuaObject, Proxy, unproxy
 from .util import *
 
@@ -37,6 +38,8 @@ class Pusher(Registry):
     def __init__(self):
         super().__init__()
         self._default_func = None
+        self._fast = {}
+        self._pack = {}
         def fallback(pi):
             if self._default_func is not None:
                 return self._default_func(pi)
@@ -49,14 +52,76 @@ class Pusher(Registry):
     def __call__(self, runtime, obj, **kwargs):
         """push ``obj`` to lua"""
         with lock_get_state(runtime) as L:
+            fast = self._fast.get(type(obj))
+            if fast is not None and fast(runtime, L, obj) is not NotImplemented:
+                return
             return self.internal_push(PushInfo(runtime, L, obj, kwargs, self))
 
+    def push_many(self, runtime, seq, **kwargs):
+        """
+        Push every object in ``seq`` to lua, in order.
+
+        Runs of objects that have a packer are packed into a
+        ``_stack_value`` array and pushed in one call. The others are
+        pushed one by one. Returns a list of the return values of
+        the pushers, None for packed objects.
+        """
+        if not isinstance(seq, (list, tuple)):
+            seq = list(seq)
+        lib = runtime.lib
+        rv = [None] * len(seq)
+        with lock_get_state(runtime) as L:
+            if not lib.lua_checkstack(L, len(seq)):
+                raise LuaErrMem(lib.LUA_ERRMEM, 'stack overflow')
+            values = runtime.ffi.new('_stack_value[]', len(seq))
+            keep = []
+            packs = self._pack
+            n = 0
+            for i, obj in enumerate(seq):
+                pack = packs.get(type(obj))
+                if pack is not None:
+                    kept = pack(runtime, values[n], obj)
+                    if kept is not NotImplemented:
+                        keep.append(kept)
+                        n += 1
+                        continue
+                if n:
+                    lib._push_values(L, values, n)
+                    n = 0
+                    del keep[:]
+                rv[i] = self(runtime, obj, **kwargs)
+            if n:
+                lib._push_values(L, values, n)
+        return rv
+
+    def register_fast(self, tp, *, pack=None):
+        """
+        A decorator. Register a fast pusher for objects whose type is
+        exactly ``tp``. It's called as ``func(runtime, L, obj)`` and
+        may return ``NotImplemented`` to fall back to the normal dispatch.
+
+        ``pack``, if given, is used by :py:meth:`push_many`. It's called
+        as ``pack(runtime, value, obj)`` to fill the ``_stack_value``
+        ``value`` and returns an object to keep alive until the value
+        is pushed, or ``NotImplemented`` to push ``obj`` normally.
+
+        Registering a pusher for ``tp`` removes its fast pusher.
+        """
+        def _(func):
+            self._fast[tp] = func
+            if pack is not None:
+                self._pack[tp] = pack
+            return func
+        return _
+
     def register_default(self, func):
         """register default pusher"""
         self._default_func = func
 
     def __setitem__(self, key, value):
         self._func.register(key)(self._convert_func(value))
+        self._fast.pop(key, None)
+        self._pack.pop(key, None)
         super().__setitem__(key, value)
 
     def __delitem__(self, key):
@@ -66,6 +131,8 @@ class Pusher(Registry):
         o = self.__class__()
         o.update(self)
         o.register_default(self._default_func)
+        o._fast = self._fast.copy()
+        o._pack = self._pack.copy()
         return o
 
 
@@ -113,6 +180,66 @@ def _(pi):
 def _(pi):
     pi.runtime.lib.lua_pushnil(pi.L)
 
+def _pack_bool(runtime, value, obj):
+    value.type = runtime.lib.LUA_TBOOLEAN
+    value.integer = obj
+
+def _pack_int(runtime, value, obj):
+    if runtime.ffi.cast('lua_Integer', obj) != obj:
+        return NotImplemented
+    value.type = runtime.lib.LUA_TNUMBER
+    value.isinteger = 1
+    value.integer = obj
+
+def _pack_float(runtime, value, obj):
+    value.type = runtime.lib.LUA_TNUMBER
+    value.isinteger = 0
+    value.number = obj
+
+def _pack_bytes(runtime, value, obj):
+    value.type = runtime.lib.LUA_TSTRING
+    value.string = buf = runtime.ffi.from_buffer(obj)
+    value.length = len(obj)
+    return buf
+
+def _pack_str(runtime, value, obj):
+    if runtime.encoding is None:
+        raise ValueError('encoding not specified')
+    return _pack_bytes(runtime, value, obj.encode(runtime.encoding))
+
+def _pack_none(runtime, value, obj):
+    value.type = runtime.lib.LUA_TNIL
+
+@std_pusher.register_fast(bool, pack=_pack_bool)
+def _(runtime, L, obj):
+    runtime.lib.lua_pushboolean(L, int(obj))
+
+@std_pusher.register_fast(int, pack=_pack_int)
+def _(runtime, L, obj):
+    if runtime.ffi.cast('lua_Integer', obj) == obj:
+        runtime.lib.lua_pushinteger(L, obj)
+    else:
+        return NotImplemented
+
+@std_pusher.register_fast(float, pack=_pack_float)
+def _(runtime, L, obj):
+    runtime.lib.lua_pushnumber(L, obj)
+
+@std_pusher.register_fast(str, pack=_pack_str)
+def _(runtime, L, obj):
+    if runtime.encoding is None:
+        raise ValueError('encoding not specified')
+    b = obj.encode(runtime.encoding)
+    runtime.lib.lua_pushlstring(L, b, len(b))
+
+@std_pusher.register_fast(bytes, pack=_pack_bytes)
+def _(runtime, L, obj):
+    runtime.lib.lua_pushlstring(L, obj, len(obj))
+
+@std_pusher.register_fast(type(None), pack=_pack_none)
+def _(runtime, L, obj):
+    runtime.lib.lua_pushnil(L)
+
 @std_pusher.register(Py2LuaProtocol)
 def _(pi):
     from .metatable import PYOBJ_SIG
@@ -124,13 +251,105 @@ def _(pi):
         return pi.obj.push_protocol(pi)
     else:
         obj = pi.obj
+    set_metatable = pi.kwargs.get('set_metatable', True)
+    cache = set_metatable and pi.runtime.identity_cache
+    if cache and lib._pycache_get(pi.L, id(obj)):
+        return
     handle = ffi.new_handle(obj)
     ffi.cast('void**', lib.lua_newuserdata(pi.L, ffi.sizeof(handle)))[0] = handle
-    if pi.kwargs.get('set_metatable', True):
+    if set_metatable:
         pi.runtime.refs.add(handle)
         lib.luaL_setmetatable(pi.L, PYOBJ_SIG)
+        if cache:
+            lib._pycache_set(pi.L, id(obj))
     return handle
 
 @std_pusher.register(Proxy)
 def _(pi):
     return pi.pusher.internal_push(pi.with_new_obj(unproxy(pi.obj)))
+
+
+class _DeepPush:
+    """
+    The state of a deep push. Tables made for containers are kept
+    in a lua table on the stack, so that a container pushed again
+    or a cycle refers to the same table.
+    """
+    def __init__(self, runtime, L, limit):
+        runtime.lib.lua_newtable(L)
+        self.index = runtime.lib.lua_gettop(L)
+        self.memo = {}
+        self.keep = []
+        self.limit = limit
+        self.count = 0
+
+    #: how many items of a sequence are pushed at once
+    chunk = 256
+
+
+@std_pusher.register(tuple)
+@std_pusher.register(list)
+@std_pusher.register(dict)
+def _deep_push(pi):
+    """
+    Push a dict, list or tuple as a lua table, converting the items
+    recursively, if deep push is on. Otherwise it's pushed as is.
+    """
+    state = pi.kwargs.get('_deep_state')
+    if state is not None:
+        return _push_container(pi, state)
+    runtime, L = pi.runtime, pi.L
+    deep = pi.kwargs.get('deep_push')
+    if deep is None:
+        deep = runtime.deep_push
+    if not deep:
+        return pi.pusher.internal_push(pi.with_new_obj(as_is(pi.obj)))
+    lib = runtime.lib
+    top = lib.lua_gettop(L)
+    limit = pi.kwargs.get('deep_push_limit', runtime.deep_push_limit)
+    try:
+        state = _DeepPush(runtime, L, limit)
+        _push_container(pi, state)
+        lib.lua_remove(L, state.index)
+    except BaseException:
+        lib.lua_settop(L, top)
+        raise
+
+def _push_container(pi, state):
+    runtime, L, obj = pi.runtime, pi.L, pi.obj
+    lib = runtime.lib
+    key = id(obj)
+    if key in state.memo:
+        lib.lua_rawgeti(L, state.index, state.memo[key])
+        return
+    n = len(obj)
+    state.count += n
+    if state.limit is not None and state.count > state.limit:
+        raise ValueError('deep push is over the limit of {} items'.format(state.limit))
+    if not lib.lua_checkstack(L, 3):
+        raise LuaErrMem(lib.LUA_ERRMEM, 'stack overflow')
+    if isinstance(obj, dict):
+        lib.lua_createtable(L, 0, n)
+    else:
+        lib.lua_createtable(L, n, 0)
+    state.keep.append(obj)
+    state.memo[key] = len(state.keep)
+    lib.lua_pushvalue(L, -1)
+    lib.lua_rawseti(L, state.index, len(state.keep))
+    kwargs = dict(pi.kwargs, _deep_state=state)
+    pusher = pi.pusher
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if isinstance(k, float) and k != k:
+                raise ValueError('cannot use nan as a lua table key')
+            pusher(runtime, k, **kwargs)
+            if lib.lua_type(L, -1) == lib.LUA_TNIL:
+                raise ValueError('cannot use nil as a lua table key')
+            pusher(runtime, v, **kwargs)
+            lib.lua_rawset(L, -3)
+    else:
+        chunk = state.chunk
+        for i in range(0, n, chunk):
+            items = obj[i:i + chunk]
+            pusher.push_many(runtime, items, **kwargs)
+            lib._setlist(L, i + 1, len(items))
@@ -1,9 +1,10 @@
 """core module contains LuaRuntime"""
 
 
-__all__ = ('LuaRuntime',)
+__all__ = ('LuaRuntime', 'MemoryInfo')
 
-from threading import RLock
+from threading import RLock, get_ident
+from collections import namedtuple
 from collections.abc import *
 from typing import *
 import importlib
@@ -14,11 +15,13 @@ import os
 from .exception import *
 from .util import *
 from .py_from_lua import *
+from .py_from_lua import LuaVolatile
 from .py_to_lua import std_pusher
 from .metatable import std_metatable
 from .protocol import *
 from .lualibs import get_default_lualib
 from .compat import unpacks_lua_table
+from .luagc import LuaGC
 
 
 class LockContext:
@@ -33,15 +36,45 @@ class LockContext:
         self._runtime.unlock()
 
 
+MemoryInfo = namedtuple('MemoryInfo', ('current', 'peak', 'limit', 'allocations', 'frees', 'failures', 'arenas', 'held'))
+
+
+class VoidLockContext:
+    """lock context for thread-confined runtime. It does nothing."""
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_void_lock_context = VoidLockContext()
+
+
 class LuaRuntime(NotCopyable):
     """
     LuaRuntime is the wrapper of main thread "lua_State".
     One process can open multiple LuaRuntime instances.
-    LuaRuntime is thread-safe.
+    LuaRuntime is thread-safe, unless it's made with ``threadsafe=False``.
     """
 
+    #: refs of dead lua object wrappers are queued and released in bulk
+    #: at the next runtime entry, or as soon as the queue reaches this length
+    #: and the runtime is not locked by another thread.
+    release_threshold = 64
+
+    #: whether the stack balance helpers in :py:mod:`ffilupa.util` assert
+    #: the balance. If false, they only restore the stack top.
+    check_stack_balance = True
+
+    #: how many instructions run between two checks of the call budget
+    budget_step = 1000
+
     def __init__(self, encoding: str = sys.getdefaultencoding(), source_encoding: Optional[str] = None, autodecode: Optional[bool] = None,
-                 lualib=None, metatable=std_metatable, pusher=std_pusher, puller=std_puller, lua_state=None, lock=None):
+                 lualib=None, metatable=std_metatable, pusher=std_pusher, puller=std_puller, lua_state=None, lock=None,
+                 compile_cache_size=128, bytecode_cache=None, threadsafe=True,
+                 check_stack_balance=True, instruction_limit=None, time_limit=None,
+                 memory_limit=None, allocator='malloc', deep_push=False, deep_push_limit=100000,
+                 identity_cache=True):
         """
         Init a LuaRuntime instance.
         This will call ``luaL_newstate`` to open a "lua_State"
@@ -54,27 +87,72 @@ class LuaRuntime(NotCopyable):
         :param metatable: the metatable for python objects. Default is :py:data:`ffilupa.metatable.std_metatable`
         :param pusher: the pusher to push objects to lua. Default is :py:data:`ffilupa.metatable.std_pusher`
         :param puller: the pulled to pull objects from lua. Default is :py:data:`ffilupa.metatable.std_puller`
+        :param compile_cache_size: how many compiled chunks :py:meth:`compile` keeps. 0 disables the cache
+        :param bytecode_cache: a :py:class:`ffilupa.bytecode.BytecodeCache` used by :py:meth:`compile_path` and ``require``
+        :param threadsafe: if false, the runtime is confined to the thread making it.
+            It's never locked, and using it from another thread raises RuntimeError
+        :param check_stack_balance: whether to assert the stack balance. Turn it off
+            in production to only restore the stack top
+        :param instruction_limit: default limit of lua instructions per call. None means no limit
+        :param time_limit: default limit of seconds per call. None means no limit
+        :param memory_limit: limit of bytes the lua state may allocate. None means no limit.
+            Allocations over it fail with :py:class:`ffilupa.exception.LuaErrMem`.
+            With the pool allocator it bounds the bytes held in arenas and large blocks
+        :param allocator: ``'malloc'`` to allocate with ``realloc``, or ``'pool'`` to serve
+            blocks up to 256 bytes from size-class free lists in 64 KB arenas, which
+            are released in bulk when the runtime is closed. Freed blocks stay in
+            the free list of their size class, so the pool holds more than lua uses
+        :param deep_push: whether to push dicts, lists and tuples as lua tables,
+            converting the items recursively, instead of as python objects.
+            Containers met again, even in a cycle, become the same table
+        :param deep_push_limit: the most items pushed in one deep push.
+            Going over it raises ValueError. None means no limit
+        :param identity_cache: whether pushing the same python object again
+            pushes the same userdata while it's alive in lua, so that it's
+            ``==`` to itself and works as a table key. If false, every push
+            makes a new userdata
         """
         super().__init__()
+        self._release_queue = []
+        self.check_stack_balance = check_stack_balance
+        self.instruction_limit = instruction_limit
+        self.time_limit = time_limit
+        self.deep_push = deep_push
+        self.deep_push_limit = deep_push_limit
+        self.identity_cache = identity_cache
+        self._pusher = pusher
+        self._puller = puller
         self.push = lambda obj, **kwargs: pusher(self, obj, **kwargs)
         self.pull = lambda index, **kwargs: puller(self, index, **kwargs)
-        self._newlock(lock)
+        self.push_many = lambda seq, **kwargs: pusher.push_many(self, seq, **kwargs)
+        self.pull_range = lambda start, stop, **kwargs: puller.pull_range(self, start, stop, **kwargs)
+        self._newlock(lock, threadsafe)
         with self.lock():
             self._exception = None
-            self.compile_cache = {}
+            self.compile_cache = LRUCache(compile_cache_size)
+            self.bytecode_cache = bytecode_cache
             self.refs = set()
             self._setencoding(encoding, source_encoding or encoding or sys.getdefaultencoding())
             if autodecode is None:
                 autodecode = encoding is not None
             self.autodecode = autodecode
             self._initlua(lualib)
+            self._peek_buffer = self.ffi.new('_stack_value*')
+            self._alloc_stats = None
             if lua_state is None:
-                self._newstate()
+                self._newstate(allocator)
+                self.memory_limit = memory_limit
                 self._openlibs()
             else:
+                if memory_limit is not None:
+                    raise ValueError('cannot limit memory of a lua state made outside')
                 self._state = self.ffi.cast('lua_State*', lua_state)
+            self._init_msgh()
             self._init_metatable(metatable)
             self._init_pylib()
+            if bytecode_cache is not None:
+                bytecode_cache.install(self)
+            self.gc = LuaGC(self)
             self._exception = None
             self._nil = LuaNil(self)
             self._G_ = self.globals()
@@ -88,6 +166,8 @@ class LuaRuntime(NotCopyable):
         the runtime. It's not necessary for common users.
         """
         self._lock.acquire()
+        if self._release_queue:
+            self._drain_release_queue()
         return LockContext(self)
 
     def unlock(self):
@@ -96,23 +176,97 @@ class LuaRuntime(NotCopyable):
         """
         self._lock.release()
 
-    def _newlock(self, lock):
+    def _release(self, ref):
+        """queue registry ref ``ref`` to be released"""
+        queue = self._release_queue
+        queue.append(ref)
+        if len(queue) >= self.release_threshold and self._lock.acquire(False):
+            try:
+                self._drain_release_queue()
+            finally:
+                self._lock.release()
+
+    def _drain_release_queue(self):
+        """release all queued registry refs. The runtime must be locked."""
+        queue = self._release_queue
+        refs = queue[:]
+        del queue[:len(refs)]
+        if self._state:
+            self.lib._unref_many(self._state, refs, len(refs))
+
+    def _newlock(self, lock, threadsafe=True):
         """make a lock"""
-        if lock is None:
+        if not threadsafe:
+            if lock is not None:
+                raise ValueError('cannot use lock with threadsafe=False')
+            self._lock = ConfinedLock()
+            self.lock = self._lock_confined
+        elif lock is None:
             self._lock = RLock()
         else:
             self._lock = lock
 
-    def _newstate(self):
-        """open a lua state"""
-        self._state = L = self.lib.luaL_newstate()
+    def _lock_confined(self):
+        """``lock`` of thread-confined runtime. Only checks the thread."""
+        if get_ident() != self._lock.owner:
+            self._lock.acquire()
+        if self._release_queue:
+            self._drain_release_queue()
+        return _void_lock_context
+
+    def _newstate(self, allocator='malloc'):
+        """open a lua state with the accounting allocator"""
+        if allocator not in ('malloc', 'pool'):
+            raise ValueError('unknown allocator {!r}'.format(allocator))
+        self._alloc_stats = self.ffi.new('_alloc_stats*')
+        self._state = L = self.lib._newstate(self._alloc_stats, allocator == 'pool')
         if L == self.ffi.NULL:
-            raise RuntimeError('"luaL_newstate" returns NULL')
+            raise RuntimeError('"lua_newstate" returns NULL')
+
+    @property
+    def memory_limit(self):
+        """
+        The limit of bytes the lua state may allocate, or None.
+        It's only enforced while lua code runs or compiles, where
+        lua can raise a memory error safely. With the pool allocator
+        it applies to :py:attr:`MemoryInfo.held` rather than ``current``.
+        """
+        self._check_alloc_stats()
+        return self._alloc_stats.limit or None
+
+    @memory_limit.setter
+    def memory_limit(self, limit):
+        self._check_alloc_stats()
+        self._alloc_stats.limit = limit or 0
+
+    def memory_info(self):
+        """
+        Returns a :py:class:`MemoryInfo` of the lua state: bytes
+        allocated now and at peak, the limit, counts of allocations,
+        frees and failed allocations, the number of pool arenas, and
+        the bytes held from the system. ``held`` is ``current`` with the
+        malloc allocator, and the bytes of the arenas and the blocks
+        larger than 256 bytes with the pool allocator.
+        """
+        self._check_alloc_stats()
+        s = self._alloc_stats
+        lib = self.lib
+        return MemoryInfo(s.current, s.peak, s.limit or None, s.allocations, s.frees, s.failures,
+                          lib._pool_arenas(s), lib._pool_held(s))
+
+    def _check_alloc_stats(self):
+        if self._alloc_stats is None:
+            raise RuntimeError('memory accounting is not available for a lua state made outside')
 
     def _openlibs(self):
         """open lua stdlibs"""
         self.lib.luaL_openlibs(self.lua_state)
 
+    def _init_msgh(self):
+        """remember the original ``debug.traceback`` for the message handler"""
+        with lock_get_state(self) as L:
+            self.lib._init_msgh(L)
+
     def _init_metatable(self, metatable):
         metatable.init_runtime(self)
 
@@ -142,7 +296,7 @@ class LuaRuntime(NotCopyable):
         if getattr(self, '_inited', False):
             with self.lock():
                 if self.lua_state:
-                    self.lib.lua_close(self.lua_state)
+                    self._closestate(self.lua_state)
                     self._state = None
 
     def _store_exception(self):
@@ -182,11 +336,18 @@ class LuaRuntime(NotCopyable):
                 namebuf.append(name)
 
     def compile_path(self, pathname):
-        """compile lua source file"""
+        """
+        compile lua source file
+
+        If the runtime has a bytecode cache, the file is
+        loaded through it.
+        """
         if not isinstance(pathname, (str, bytes)):
             pathname = str(pathname)
         if isinstance(pathname, str):
             pathname = os.fsencode(pathname)
+        if self.bytecode_cache is not None:
+            return self.bytecode_cache.load(self, pathname)
         with lock_get_state(self) as L:
             with ensure_stack_balance(self):
                 status = self.lib.luaL_loadfile(L, pathname)
@@ -197,17 +358,34 @@ class LuaRuntime(NotCopyable):
                     return obj
 
     def compile(self, code, name=b'=python'):
-        """compile lua code"""
+        """
+        compile lua code
+
+        The bytecode of compiled chunks is kept in :py:attr:`compile_cache`,
+        keyed by the code and ``name``. A cache hit loads the bytecode,
+        so every call returns a new function whose first upvalue is the
+        global table, as ``load`` does, and changing one of them never
+        affects another.
+        """
         if isinstance(code, str):
             code = code.encode(self.source_encoding)
+        key = (code, name)
+        lib = self.lib
         with lock_get_state(self) as L:
             with ensure_stack_balance(self):
-                status = self.lib.luaL_loadbuffer(L, code, len(code), name)
+                data = self.compile_cache.get(key)
+                if data is not None:
+                    status = lib._loadbufferx(L, data, len(data), name, b'b')
+                else:
+                    status = lib._loadbufferx(L, code, len(code), name, self.ffi.NULL)
                 obj = self.pull(-1)
-                if status != self.lib.LUA_OK:
+                if status != lib.LUA_OK:
                     raise LuaErr.new(self, status, obj, self.encoding)
-                else:
-                    return obj
+                if data is None and self.compile_cache.maxsize > 0 and isinstance(obj, LuaFunction):
+                    lib.lua_pushcfunction(L, lib._get_dump_client())
+                    self.compile_cache.put(key, LuaCallable.__call__(
+                        LuaVolatile(self, -1), obj, False, set_metatable=False, autodecode=False))
+                return obj
 
     def execute(self, code, *args):
         """
@@ -280,6 +458,84 @@ class LuaRuntime(NotCopyable):
                             i += 1
                 return LuaTable(self, -1)
 
+    def json_loads(self, buf, *, null='nil', integers='auto'):
+        """
+        Decode JSON document ``buf`` right into lua values, without
+        making python objects on the way. Returns the pulled top value,
+        so objects and arrays come back as :py:class:`ffilupa.py_from_lua.LuaTable`.
+
+        :param buf: str, which is encoded in utf-8, or a bytes-like object
+        :param null: ``'nil'`` to decode null as nil, which drops it from
+            objects and leaves holes in arrays, or ``'sentinel'`` to decode
+            it as the NULL lightuserdata, as lua-cjson does
+        :param integers: ``'auto'`` to decode numbers without fraction and
+            exponent, which fit lua_Integer, as integers, or ``'float'`` to
+            decode all numbers as floats
+
+        Invalid JSON raises ValueError.
+        """
+        if null not in ('nil', 'sentinel'):
+            raise ValueError('null must be \'nil\' or \'sentinel\'')
+        if integers not in ('auto', 'float'):
+            raise ValueError('integers must be \'auto\' or \'float\'')
+        if isinstance(buf, str):
+            buf = buf.encode('utf-8')
+        data = self.ffi.from_buffer(buf)
+        state = self.ffi.new('_json_state*')
+        state.buf = data
+        state.len = len(data)
+        state.null_sentinel = null == 'sentinel'
+        state.float_only = integers == 'float'
+        with lock_get_state(self) as L:
+            with ensure_stack_balance(self):
+                status = self.lib._json_decode(L, state)
+                obj = self.pull(-1)
+                if status == self.lib.LUA_ERRRUN:
+                    raise ValueError(obj.decode(self.encoding) if isinstance(obj, bytes) else obj)
+                elif status != self.lib.LUA_OK:
+                    raise LuaErr.new(self, status, obj, self.encoding)
+                return obj
+
+    def json_dumps(self, obj, *, arrays='auto', empty='object', floats='compact'):
+        """
+        Encode ``obj`` to a JSON document in C, walking lua tables
+        directly. ``obj`` is pushed first, so it may also be a python
+        value which is pushed as a lua value. Returns bytes.
+
+        nil and the NULL lightuserdata are encoded as null. Object keys
+        must be strings or numbers. Metatables are ignored.
+
+        :param arrays: ``'auto'`` to encode tables whose keys are exactly
+            ``1..n`` as arrays, or ``'never'`` to encode all tables as objects
+        :param empty: ``'object'`` or ``'array'``, how to encode empty tables
+        :param floats: ``'compact'`` to write integral floats like integers,
+            or ``'strict'`` to append ``.0`` to them, so that they decode
+            back as floats
+
+        Unencodable values, nan, inf and nesting deeper than 1000
+        levels, which also catches cycles, raise ValueError.
+        """
+        if arrays not in ('auto', 'never'):
+            raise ValueError('arrays must be \'auto\' or \'never\'')
+        if empty not in ('object', 'array'):
+            raise ValueError('empty must be \'object\' or \'array\'')
+        if floats not in ('compact', 'strict'):
+            raise ValueError('floats must be \'compact\' or \'strict\'')
+        state = self.ffi.new('_json_state*')
+        state.never_arrays = arrays == 'never'
+        state.empty_array = empty == 'array'
+        state.strict_floats = floats == 'strict'
+        with lock_get_state(self) as L:
+            with ensure_stack_balance(self):
+                self.push(obj)
+                status = self.lib._json_encode(L, state)
+                if status == self.lib.LUA_OK:
+                    return self.pull(-1, autodecode=False)
+                err = self.pull(-1)
+                if status == self.lib.LUA_ERRRUN:
+                    raise ValueError(err.decode(self.encoding) if isinstance(err, bytes) else err)
+                raise LuaErr.new(self, status, err, self.encoding)
+
     def _init_pylib(self):
         """
         This method will be called at init time to setup
@@ -386,7 +642,13 @@ class LuaRuntime(NotCopyable):
         """close this LuaRuntime"""
         with lock_get_state(self) as L:
             self._state = None
-            self.lib.lua_close(L)
+            self._closestate(L)
+
+    def _closestate(self, L):
+        """close lua state ``L`` and release the allocator's arenas"""
+        self.lib.lua_close(L)
+        if self._alloc_stats is not None:
+            self.lib._pool_destroy(self._alloc_stats)
 
     def __enter__(self):
         return self
@@ -397,7 +659,28 @@ class LuaRuntime(NotCopyable):
 
 class VoidLock:
     def acquire(self, blocking=True, timeout=-1):
+        return True
+
+    def release(self):
         pass
 
+
+class ConfinedLock:
+    """
+    Lock of thread-confined runtime. It never blocks.
+    Acquiring it from a thread other than the owner raises
+    RuntimeError, or returns False if not ``blocking``.
+    """
+    def __init__(self):
+        self.owner = get_ident()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if get_ident() == self.owner:
+            return True
+        if blocking:
+            raise RuntimeError('the runtime is confined to thread {}, '
+                               'but used in thread {}'.format(self.owner, get_ident()))
+        return False
+
     def release(self):
         pass
@@ -3,34 +3,44 @@
 
 __all__ = (
     'assert_stack_balance', 'ensure_stack_balance', 'lock_get_state',
-    'partial', 'NotCopyable', 'reraise', 'Registry',)
+    'partial', 'NotCopyable', 'reraise', 'Registry',
+    'CacheInfo', 'LRUCache',)
 
-from collections import UserDict
-from contextlib import contextmanager
+from collections import UserDict, OrderedDict, namedtuple
 import functools
 
 
-@contextmanager
-def assert_stack_balance(runtime):
+class assert_stack_balance:
     """
     A context manager. Accepts a lua state and raise
     AssertionError if the lua stack top got from
     ``lua_gettop()`` is different between the enter
     time and exit time. This helper helps to assert
     the stack balance.
+
+    If ``runtime.check_stack_balance`` is false, nothing
+    is asserted and the stack top is just restored.
     """
-    L = runtime.lua_state
-    lib = runtime.lib
-    oldtop = lib.lua_gettop(L)
-    try:
-        yield
-    finally:
-        newtop = lib.lua_gettop(L)
-        assert oldtop == newtop, 'stack unbalance'
+    __slots__ = ('_runtime', '_L', '_oldtop')
+
+    def __init__(self, runtime):
+        self._runtime = runtime
+
+    def __enter__(self):
+        runtime = self._runtime
+        self._L = L = runtime.lua_state
+        self._oldtop = runtime.lib.lua_gettop(L)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        lib = self._runtime.lib
+        if self._runtime.check_stack_balance:
+            newtop = lib.lua_gettop(self._L)
+            assert self._oldtop == newtop, 'stack unbalance'
+        else:
+            lib.lua_settop(self._L, self._oldtop)
 
 
-@contextmanager
-def ensure_stack_balance(runtime):
+class ensure_stack_balance:
     """
     A context manager. Accepts a lua state and pops
     the lua stack at exit time to make the top of
@@ -40,27 +50,45 @@ def ensure_stack_balance(runtime):
     is less than enter time, AssertionError will be
     raised. This helper helps to ensure the stack
     balance.
+
+    If ``runtime.check_stack_balance`` is false, the stack
+    top is restored without any assertion.
     """
-    L = runtime.lua_state
-    lib = runtime.lib
-    oldtop = lib.lua_gettop(L)
-    try:
-        yield
-    finally:
-        newtop = lib.lua_gettop(L)
-        assert oldtop <= newtop, 'stack unbalance'
-        lib.lua_settop(L, oldtop)
+    __slots__ = ('_runtime', '_L', '_oldtop')
+
+    def __init__(self, runtime):
+        self._runtime = runtime
+
+    def __enter__(self):
+        runtime = self._runtime
+        self._L = L = runtime.lua_state
+        self._oldtop = runtime.lib.lua_gettop(L)
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        lib = self._runtime.lib
+        if self._runtime.check_stack_balance:
+            newtop = lib.lua_gettop(self._L)
+            assert self._oldtop <= newtop, 'stack unbalance'
+        lib.lua_settop(self._L, self._oldtop)
 
-@contextmanager
-def lock_get_state(runtime):
+
+class lock_get_state:
     """
     A context manager. Locks ``runtime`` and returns
     the lua state of it. The runtime will be unlocked
     at exit time.
     """
-    with runtime.lock():
-        yield runtime.lua_state
+    __slots__ = ('_runtime', '_context')
+
+    def __init__(self, runtime):
+        self._runtime = runtime
+
+    def __enter__(self):
+        self._context = self._runtime.lock()
+        return self._runtime.lua_state
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._context.__exit__(exc_type, exc_value, traceback)
 
 
 def partial(func, *frozenargs):
@@ -107,3 +135,52 @@ class Registry(UserDict):
             self[name] = func
             return func
         return _
+
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'evictions', 'maxsize', 'currsize'))
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used item.
+    ``maxsize`` of 0 disables the cache.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value of ``key`` and marks it as recently used."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Cache ``value`` under ``key``, evicting old items if it's full."""
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Remove all items. The counters are kept."""
+        self._data.clear()
+
+    def info(self):
+        """Returns a :py:class:`CacheInfo` of the cache."""
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
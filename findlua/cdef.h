@@ -3,3 +3,80 @@ lua_CFunction _get_caller_client(void);
 lua_CFunction _get_arith_client(void);
 lua_CFunction _get_compare_client(void);
 lua_CFunction _get_index_client(void);
+lua_CFunction _get_dump_client(void);
+void _init_msgh(lua_State*);
+int _pcall(lua_State*, int);
+void _unref_many(lua_State*, const int*, int);
+typedef struct {
+    int type;
+    int isinteger;
+    lua_Integer integer;
+    lua_Number number;
+    const char *string;
+    size_t length;
+} _stack_value;
+int _peek_value(lua_State*, int, _stack_value*);
+void _push_values(lua_State*, const _stack_value*, int);
+void _peek_values(lua_State*, int, int, _stack_value*);
+typedef struct _budget {
+    long long instructions;
+    double deadline;
+    int step;
+    int exceeded;
+    struct _budget *prev;
+    lua_Hook oldhook;
+    int oldmask;
+    int oldcount;
+} _budget;
+void _budget_begin(lua_State*, _budget*, double);
+void _budget_end(lua_State*, _budget*);
+typedef struct {
+    size_t current;
+    size_t peak;
+    size_t limit;
+    unsigned long long allocations;
+    unsigned long long frees;
+    unsigned long long failures;
+    int protected;
+    void *pool;
+    size_t large;
+} _alloc_stats;
+lua_State *_newstate(_alloc_stats*, int);
+void _pool_destroy(_alloc_stats*);
+size_t _pool_arenas(_alloc_stats*);
+size_t _pool_held(_alloc_stats*);
+int _loadbufferx(lua_State*, const char*, size_t, const char*, const char*);
+void _gc_install(lua_State*);
+lua_Integer _gc_cycles(lua_State*);
+int _gc_protected(lua_State*, int, int, int*);
+int _cycle_mark(lua_State*, int);
+int _next_batch(lua_State*, int);
+#define _WALK_OBJECT 100
+#define _WALK_ARRAY 1
+#define _WALK_SEEN 2
+#define _WALK_OPEN 4
+typedef struct {
+    _stack_value *out;
+    size_t cap;
+    size_t n;
+    int maxdepth;
+    int mask;
+    int sequences;
+    int wrapcycles;
+    lua_Integer tables;
+} _walk_state;
+int _walk(lua_State*, _walk_state*);
+void _setlist(lua_State*, lua_Integer, int);
+typedef struct {
+    const char *buf;
+    size_t len;
+    int null_sentinel;
+    int float_only;
+    int never_arrays;
+    int empty_array;
+    int strict_floats;
+} _json_state;
+int _json_decode(lua_State*, const _json_state*);
+int _json_encode(lua_State*, const _json_state*);
+int _pycache_get(lua_State*, intptr_t);
+void _pycache_set(lua_State*, intptr_t);
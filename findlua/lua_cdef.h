@@ -301,6 +301,8 @@ extern const int LUA_GCSTEP;
 extern const int LUA_GCSETPAUSE;
 extern const int LUA_GCSETSTEPMUL;
 extern const int LUA_GCISRUNNING;	//VER: >=5.2
+extern const int LUA_GCGEN;	//VER: <5.3,>=5.2
+extern const int LUA_GCINC;	//VER: <5.3,>=5.2
 
 int (lua_gc) (lua_State *L, int what, int data);
 
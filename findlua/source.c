@@ -1,20 +1,18 @@
 #include "lua.h"
 #include "lauxlib.h"
 #include "lualib.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <errno.h>
+#include <math.h>
 
-static int _caller_server(lua_State*);
-
-static int _caller_client(lua_State *L){
-    const int result = _caller_server(L);
-    if(result == -1)
-        return lua_error(L);
-    else
-        return result;
-}
-
-static lua_CFunction _get_caller_client(void){
-    return _caller_client;
-}
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <time.h>
+#endif
 
 static int _arith_client(lua_State *L){
     const int op = luaL_checkinteger(L, 1);
@@ -57,3 +55,1387 @@ static int _index_client(lua_State *L){
 static lua_CFunction _get_index_client(void){
     return _index_client;
 }
+
+static int _hasmetafield(lua_State *L, int obj, const char *e){
+    if(luaL_getmetafield(L, obj, e)){
+        lua_pop(L, 1);
+        return 1;
+    }
+    return 0;
+}
+
+static const char _traceback_key = 0;
+
+static void _init_msgh(lua_State *L){
+    lua_getglobal(L, "debug");
+    if(lua_istable(L, -1))
+        lua_getfield(L, -1, "traceback");
+    else
+        lua_pushnil(L);
+    lua_rawsetp(L, LUA_REGISTRYINDEX, &_traceback_key);
+    lua_pop(L, 1);
+}
+
+static int _msgh(lua_State *L){
+    lua_getglobal(L, "debug");
+    if(lua_istable(L, -1) || _hasmetafield(L, -1, "__index")){
+        lua_getfield(L, -1, "traceback");
+        if(lua_isfunction(L, -1) || _hasmetafield(L, -1, "__call")){
+            lua_pushvalue(L, 1);
+            lua_rawgetp(L, LUA_REGISTRYINDEX, &_traceback_key);
+            if(lua_rawequal(L, -1, -3)){
+                /* skip the frame of this handler */
+                lua_pop(L, 1);
+                lua_pushinteger(L, 2);
+                lua_call(L, 2, 1);
+            }
+            else{
+                lua_pop(L, 1);
+                lua_call(L, 1, 1);
+            }
+            return 1;
+        }
+    }
+    lua_settop(L, 1);
+    return 1;
+}
+
+#define _POOL_GRAIN 16
+#define _POOL_CLASSES 16
+#define _POOL_MAX (_POOL_GRAIN * _POOL_CLASSES)
+#define _POOL_ARENA_SIZE 65536
+
+typedef union _arena {
+    union _arena *next;
+    char pad[_POOL_GRAIN];
+} _arena;
+
+typedef struct {
+    _arena *arenas;
+    void *free[_POOL_CLASSES];
+    char *bump;
+    size_t left;
+    size_t narenas;
+} _pool;
+
+typedef struct {
+    size_t current;
+    size_t peak;
+    size_t limit;
+    unsigned long long allocations;
+    unsigned long long frees;
+    unsigned long long failures;
+    int protected;
+    _pool *pool;
+    size_t large;
+} _alloc_stats;
+
+/* bytes taken from the system. in pool mode, freed blocks stay in the
+   free lists of their size classes, so this is what the limit bounds */
+static size_t _pool_held(_alloc_stats *s){
+    if(s->pool == NULL)
+        return s->current;
+    return s->pool->narenas * _POOL_ARENA_SIZE + s->large;
+}
+
+/* the limit is only enforced in protected calls, where lua can raise LUA_ERRMEM safely */
+static int _over_limit(_alloc_stats *s, size_t held, size_t grow){
+    return s->limit && s->protected && held + grow > s->limit;
+}
+
+static void _pool_free(_pool *p, void *block, size_t size){
+    const size_t c = (size - 1) / _POOL_GRAIN;
+    *(void**)block = p->free[c];
+    p->free[c] = block;
+}
+
+static void *_pool_alloc(_alloc_stats *s, size_t size){
+    _pool *p = s->pool;
+    const size_t c = (size - 1) / _POOL_GRAIN;
+    const size_t bsize = (c + 1) * _POOL_GRAIN;
+    void *block = p->free[c];
+    if(block != NULL){
+        p->free[c] = *(void**)block;
+        return block;
+    }
+    if(p->left < bsize){
+        _arena *a;
+        if(_over_limit(s, _pool_held(s), _POOL_ARENA_SIZE))
+            return NULL;
+        a = (_arena*)malloc(_POOL_ARENA_SIZE);
+        if(a == NULL)
+            return NULL;
+        /* hand the tail of the old arena to the free list of its size class */
+        if(p->left >= _POOL_GRAIN)
+            _pool_free(p, p->bump, p->left / _POOL_GRAIN * _POOL_GRAIN);
+        a->next = p->arenas;
+        p->arenas = a;
+        ++p->narenas;
+        p->bump = (char*)(a + 1);
+        p->left = _POOL_ARENA_SIZE - sizeof(_arena);
+    }
+    block = p->bump;
+    p->bump += bsize;
+    p->left -= bsize;
+    return block;
+}
+
+static void _raw_free(_alloc_stats *s, void *ptr, size_t osize){
+    if(s->pool != NULL && osize <= _POOL_MAX){
+        _pool_free(s->pool, ptr, osize);
+    }else{
+        if(s->pool != NULL)
+            s->large -= osize;
+        free(ptr);
+    }
+}
+
+static void *_raw_realloc(_alloc_stats *s, void *ptr, size_t osize, size_t nsize){
+    void *p;
+    if(s->pool == NULL)
+        return realloc(ptr, nsize);
+    if(ptr != NULL){
+        if(osize <= _POOL_MAX && nsize <= _POOL_MAX && (osize - 1) / _POOL_GRAIN == (nsize - 1) / _POOL_GRAIN)
+            return ptr;
+        if(osize > _POOL_MAX && nsize > _POOL_MAX){
+            if(nsize > osize && _over_limit(s, _pool_held(s), nsize - osize))
+                return NULL;
+            p = realloc(ptr, nsize);
+            if(p != NULL)
+                s->large = s->large - osize + nsize;
+            return p;
+        }
+    }
+    if(nsize <= _POOL_MAX){
+        p = _pool_alloc(s, nsize);
+    }else{
+        p = _over_limit(s, _pool_held(s), nsize) ? NULL : malloc(nsize);
+        if(p != NULL)
+            s->large += nsize;
+    }
+    if(p != NULL && ptr != NULL){
+        memcpy(p, ptr, osize < nsize ? osize : nsize);
+        _raw_free(s, ptr, osize);
+    }
+    return p;
+}
+
+static void *_accounting_alloc(void *ud, void *ptr, size_t osize, size_t nsize){
+    _alloc_stats *s = (_alloc_stats*)ud;
+    void *p;
+    if(ptr == NULL)
+        osize = 0;
+    if(nsize == 0){
+        if(ptr != NULL){
+            _raw_free(s, ptr, osize);
+            s->current -= osize;
+            ++s->frees;
+        }
+        return NULL;
+    }
+    /* the pool checks the bytes it holds itself */
+    if(nsize > osize && s->pool == NULL && _over_limit(s, s->current - osize, nsize)){
+        ++s->failures;
+        return NULL;
+    }
+    p = _raw_realloc(s, ptr, osize, nsize);
+    if(p == NULL){
+        if(nsize > osize)
+            ++s->failures;
+        return NULL;
+    }
+    s->current = s->current - osize + nsize;
+    if(s->current > s->peak)
+        s->peak = s->current;
+    if(ptr == NULL)
+        ++s->allocations;
+    return p;
+}
+
+static void _pool_destroy(_alloc_stats *s){
+    _pool *p = s->pool;
+    if(p == NULL)
+        return;
+    while(p->arenas != NULL){
+        _arena *next = p->arenas->next;
+        free(p->arenas);
+        p->arenas = next;
+    }
+    free(p);
+    s->pool = NULL;
+}
+
+static size_t _pool_arenas(_alloc_stats *s){
+    return s->pool != NULL ? s->pool->narenas : 0;
+}
+
+static int _atpanic(lua_State *L){
+    const char *msg = lua_tostring(L, -1);
+    fprintf(stderr, "PANIC: unprotected error in call to Lua API (%s)\n", msg ? msg : "?");
+    fflush(stderr);
+    return 0;
+}
+
+static lua_State *_newstate(_alloc_stats *s, int pooled){
+    lua_State *L;
+    if(pooled){
+        s->pool = (_pool*)calloc(1, sizeof(_pool));
+        if(s->pool == NULL)
+            return NULL;
+    }
+    L = lua_newstate(_accounting_alloc, s);
+    if(L != NULL)
+        lua_atpanic(L, _atpanic);
+    else
+        _pool_destroy(s);
+    return L;
+}
+
+static _alloc_stats *_get_alloc_stats(lua_State *L){
+    void *ud;
+    if(lua_getallocf(L, &ud) == _accounting_alloc)
+        return (_alloc_stats*)ud;
+    return NULL;
+}
+
+static int _caller_server(lua_State*);
+
+static int _caller_client(lua_State *L){
+    /* python calls the lua api unprotected, so lift the memory limit
+       while it runs, or a failed allocation would longjmp through it */
+    _alloc_stats *s = _get_alloc_stats(L);
+    int protected = 0, result;
+    if(s){
+        protected = s->protected;
+        s->protected = 0;
+    }
+    result = _caller_server(L);
+    if(s)
+        s->protected = protected;
+    if(result == -1)
+        return lua_error(L);
+    else
+        return result;
+}
+
+static lua_CFunction _get_caller_client(void){
+    return _caller_client;
+}
+
+static int _pcall(lua_State *L, int nargs){
+    const int base = lua_gettop(L) - nargs;
+    _alloc_stats *s = _get_alloc_stats(L);
+    int status;
+    lua_pushcfunction(L, _msgh);
+    lua_insert(L, base);
+    if(s)
+        ++s->protected;
+    status = lua_pcall(L, nargs, LUA_MULTRET, base);
+    if(s)
+        --s->protected;
+    lua_remove(L, base);
+    return status;
+}
+
+static int _loadbufferx(lua_State *L, const char *buff, size_t sz, const char *name, const char *mode){
+    _alloc_stats *s = _get_alloc_stats(L);
+    int status;
+    if(s)
+        ++s->protected;
+    status = luaL_loadbufferx(L, buff, sz, name, mode);
+    if(s)
+        --s->protected;
+    return status;
+}
+
+static void _unref_many(lua_State *L, const int *refs, int n){
+    int i;
+    for(i = 0; i < n; ++i)
+        luaL_unref(L, LUA_REGISTRYINDEX, refs[i]);
+}
+
+typedef struct {
+    int type;
+    int isinteger;
+    lua_Integer integer;
+    lua_Number number;
+    const char *string;
+    size_t length;
+} _stack_value;
+
+static int _peek_value(lua_State *L, int idx, _stack_value *out){
+    out->type = lua_type(L, idx);
+    switch(out->type){
+        case LUA_TNUMBER:
+            out->integer = lua_tointegerx(L, idx, &out->isinteger);
+            out->number = lua_tonumber(L, idx);
+            break;
+        case LUA_TBOOLEAN:
+            out->integer = lua_toboolean(L, idx);
+            break;
+        case LUA_TSTRING:
+            out->string = lua_tolstring(L, idx, &out->length);
+            break;
+    }
+    return out->type;
+}
+
+static void _push_values(lua_State *L, const _stack_value *values, int n){
+    int i;
+    for(i = 0; i < n; ++i){
+        const _stack_value *v = &values[i];
+        switch(v->type){
+            case LUA_TBOOLEAN:
+                lua_pushboolean(L, (int)v->integer);
+                break;
+            case LUA_TNUMBER:
+                if(v->isinteger)
+                    lua_pushinteger(L, v->integer);
+                else
+                    lua_pushnumber(L, v->number);
+                break;
+            case LUA_TSTRING:
+                lua_pushlstring(L, v->string, v->length);
+                break;
+            default:
+                lua_pushnil(L);
+        }
+    }
+}
+
+static void _peek_values(lua_State *L, int start, int n, _stack_value *out){
+    int i;
+    for(i = 0; i < n; ++i)
+        _peek_value(L, start + i, &out[i]);
+}
+
+static int _dump_writer(lua_State *L, const void *p, size_t sz, void *ud){
+    (void)L;
+    luaL_addlstring((luaL_Buffer*)ud, (const char*)p, sz);
+    return 0;
+}
+
+static int _dump_client(lua_State *L){
+    luaL_Buffer b;
+    const int strip = lua_toboolean(L, 2);
+    luaL_checktype(L, 1, LUA_TFUNCTION);
+    lua_settop(L, 1);
+    luaL_buffinit(L, &b);
+#if LUA_VERSION_NUM >= 503
+    if(lua_dump(L, _dump_writer, &b, strip) != 0)
+#else
+    (void)strip;
+    if(lua_dump(L, _dump_writer, &b) != 0)
+#endif
+        return luaL_error(L, "unable to dump given function");
+    luaL_pushresult(&b);
+    return 1;
+}
+
+static lua_CFunction _get_dump_client(void){
+    return _dump_client;
+}
+
+typedef struct _budget {
+    long long instructions;
+    double deadline;
+    int step;
+    int exceeded;
+    struct _budget *prev;
+    lua_Hook oldhook;
+    int oldmask;
+    int oldcount;
+} _budget;
+
+static const char _budget_key = 0;
+
+static double _monotonic(void){
+#ifdef _WIN32
+    return GetTickCount64() / 1000.0;
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+#endif
+}
+
+static void _budget_hook(lua_State *L, lua_Debug *ar){
+    _budget *b, *p, *q;
+    const int count = lua_gethookcount(L);
+    double now = 0;
+    int exceeded = 0;
+    (void)ar;
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_budget_key);
+    b = (_budget*)lua_touserdata(L, -1);
+    lua_pop(L, 1);
+    if(b == NULL)
+        return;
+    if(!b->exceeded){
+        /* charge the budgets of the enclosing calls too, so that a
+           nested call can't escape them */
+        for(p = b; p != NULL && !exceeded; p = p->prev){
+            if(p->instructions >= 0){
+                p->instructions -= count;
+                if(p->instructions < 0)
+                    exceeded = 1;
+            }
+            if(!exceeded && p->deadline > 0){
+                if(now == 0)
+                    now = _monotonic();
+                if(now >= p->deadline)
+                    exceeded = 2;
+            }
+            if(exceeded)
+                for(q = b; q != p->prev; q = q->prev)
+                    q->exceeded = exceeded;
+        }
+        if(!exceeded)
+            return;
+        /* keep failing on every instruction so that pcall in lua can't swallow it */
+        lua_sethook(L, _budget_hook, LUA_MASKCOUNT, 1);
+    }
+    luaL_error(L, b->exceeded == 1 ? "instruction limit exceeded" : "time limit exceeded");
+}
+
+static void _budget_begin(lua_State *L, _budget *b, double timeout){
+    _budget *p;
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_budget_key);
+    b->prev = (_budget*)lua_touserdata(L, -1);
+    lua_pop(L, 1);
+    b->exceeded = 0;
+    b->deadline = timeout > 0 ? _monotonic() + timeout : 0;
+    for(p = b; p != NULL; p = p->prev)
+        if(p->instructions >= 0 && p->instructions < b->step)
+            b->step = p->instructions > 0 ? (int)p->instructions : 1;
+    b->oldhook = lua_gethook(L);
+    b->oldmask = lua_gethookmask(L);
+    b->oldcount = lua_gethookcount(L);
+    lua_pushlightuserdata(L, b);
+    lua_rawsetp(L, LUA_REGISTRYINDEX, &_budget_key);
+    lua_sethook(L, _budget_hook, LUA_MASKCOUNT, b->step);
+}
+
+static void _budget_end(lua_State *L, _budget *b){
+    if(b->prev)
+        lua_pushlightuserdata(L, b->prev);
+    else
+        lua_pushnil(L);
+    lua_rawsetp(L, LUA_REGISTRYINDEX, &_budget_key);
+    lua_sethook(L, b->oldhook, b->oldmask, b->oldcount);
+}
+
+static const char _gc_cycles_key = 0;
+static const char _gc_sentinel_key = 0;
+
+static void _gc_arm(lua_State *L){
+    lua_newuserdata(L, 0);
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_gc_sentinel_key);
+    lua_setmetatable(L, -2);
+    lua_pop(L, 1);
+}
+
+static int _gc_sentinel(lua_State *L){
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_gc_cycles_key);
+    lua_pushinteger(L, lua_tointeger(L, -1) + 1);
+    lua_rawsetp(L, LUA_REGISTRYINDEX, &_gc_cycles_key);
+    lua_pop(L, 1);
+    /* the next garbage sentinel, finalized at the end of the next cycle */
+    _gc_arm(L);
+    return 0;
+}
+
+static void _gc_install(lua_State *L){
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_gc_sentinel_key);
+    if(lua_isnil(L, -1)){
+        lua_newtable(L);
+        lua_pushcfunction(L, _gc_sentinel);
+        lua_setfield(L, -2, "__gc");
+        lua_rawsetp(L, LUA_REGISTRYINDEX, &_gc_sentinel_key);
+        lua_pushinteger(L, 0);
+        lua_rawsetp(L, LUA_REGISTRYINDEX, &_gc_cycles_key);
+        _gc_arm(L);
+    }
+    lua_pop(L, 1);
+}
+
+static lua_Integer _gc_cycles(lua_State *L){
+    lua_Integer n;
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_gc_cycles_key);
+    n = lua_tointeger(L, -1);
+    lua_pop(L, 1);
+    return n;
+}
+
+static int _gc_protected_client(lua_State *L){
+    lua_pushinteger(L, lua_gc(L, (int)lua_tointeger(L, 1), (int)lua_tointeger(L, 2)));
+    return 1;
+}
+
+static int _gc_protected(lua_State *L, int what, int data, int *result){
+    int status;
+    lua_pushcfunction(L, _gc_protected_client);
+    lua_pushinteger(L, what);
+    lua_pushinteger(L, data);
+    status = lua_pcall(L, 2, 1, 0);
+    if(status == LUA_OK){
+        *result = (int)lua_tointeger(L, -1);
+        lua_pop(L, 1);
+    }
+    return status;
+}
+
+/* cross-heap cycle marking. the stack of _cycle_mark_client is
+   seen, found, pyobject metatable, excluded registry keys, work, roots... */
+enum {_CM_SEEN = 1, _CM_FOUND, _CM_PYMT, _CM_EXCLUDED, _CM_WORK, _CM_ROOTS};
+
+static void _cycle_enqueue(lua_State *L, int idx, lua_Integer *n){
+    switch(lua_type(L, idx)){
+    case LUA_TTABLE: case LUA_TFUNCTION: case LUA_TUSERDATA: case LUA_TTHREAD:
+        break;
+    default:
+        return;
+    }
+    idx = lua_absindex(L, idx);
+    lua_pushvalue(L, idx);
+    lua_rawget(L, _CM_SEEN);
+    if(!lua_isnil(L, -1)){
+        lua_pop(L, 1);
+        return;
+    }
+    lua_pop(L, 1);
+    lua_pushvalue(L, idx);
+    lua_pushboolean(L, 1);
+    lua_rawset(L, _CM_SEEN);
+    lua_pushvalue(L, idx);
+    lua_rawseti(L, _CM_WORK, ++*n);
+}
+
+static void _cycle_enqueue_from(lua_State *L, lua_State *co, lua_Integer *n){
+    lua_xmove(co, L, 1);
+    _cycle_enqueue(L, -1, n);
+    lua_pop(L, 1);
+}
+
+static void _cycle_trace_thread(lua_State *L, lua_State *co, lua_Integer *n){
+    lua_Debug ar;
+    int level, i;
+    if(co == L)
+        return;
+    if(!lua_checkstack(co, 2))
+        luaL_error(L, "stack overflow");
+    for(level = 0; lua_getstack(co, level, &ar); ++level){
+        lua_getinfo(co, "f", &ar);
+        _cycle_enqueue_from(L, co, n);
+        for(i = 1; lua_getlocal(co, &ar, i); ++i)
+            _cycle_enqueue_from(L, co, n);
+        for(i = -1; lua_getlocal(co, &ar, i); --i)
+            _cycle_enqueue_from(L, co, n);
+    }
+    for(i = 1; i <= lua_gettop(co); ++i){
+        lua_pushvalue(co, i);
+        _cycle_enqueue_from(L, co, n);
+    }
+}
+
+static void _cycle_trace(lua_State *L, int v, lua_Integer *n){
+    int i, registry, weakvalues = 0;
+    switch(lua_type(L, v)){
+    case LUA_TTABLE:
+        if(lua_getmetatable(L, v)){
+            _cycle_enqueue(L, -1, n);
+            /* weak values don't keep anything alive. weak keys are
+               traced anyway, which is only conservative */
+            lua_pushliteral(L, "__mode");
+            lua_rawget(L, -2);
+            weakvalues = lua_type(L, -1) == LUA_TSTRING && strchr(lua_tostring(L, -1), 'v') != NULL;
+            lua_pop(L, 2);
+        }
+        lua_pushvalue(L, LUA_REGISTRYINDEX);
+        registry = lua_rawequal(L, -1, v);
+        lua_pop(L, 1);
+        lua_pushnil(L);
+        while(lua_next(L, v)){
+            if(registry){
+                lua_pushvalue(L, -2);
+                lua_rawget(L, _CM_EXCLUDED);
+                if(!lua_isnil(L, -1)){
+                    lua_pop(L, 2);
+                    continue;
+                }
+                lua_pop(L, 1);
+            }
+            _cycle_enqueue(L, -2, n);
+            if(!weakvalues)
+                _cycle_enqueue(L, -1, n);
+            lua_pop(L, 1);
+        }
+        break;
+    case LUA_TUSERDATA:
+        if(lua_getmetatable(L, v)){
+            if(lua_rawequal(L, -1, _CM_PYMT)){
+                lua_pushvalue(L, v);
+                lua_rawseti(L, _CM_FOUND, (lua_Integer)lua_rawlen(L, _CM_FOUND) + 1);
+            }
+            _cycle_enqueue(L, -1, n);
+            lua_pop(L, 1);
+        }
+        lua_getuservalue(L, v);
+        _cycle_enqueue(L, -1, n);
+        lua_pop(L, 1);
+        break;
+    case LUA_TFUNCTION:
+        for(i = 1; lua_getupvalue(L, v, i); ++i){
+            _cycle_enqueue(L, -1, n);
+            lua_pop(L, 1);
+        }
+        break;
+    case LUA_TTHREAD:
+        _cycle_trace_thread(L, lua_tothread(L, v), n);
+        break;
+    }
+}
+
+static int _cycle_mark_client(lua_State *L){
+    lua_Integer n = 0;
+    int i, top = lua_gettop(L);
+    lua_newtable(L);
+    lua_insert(L, _CM_WORK);
+    for(i = _CM_ROOTS; i <= top + 1; ++i)
+        _cycle_enqueue(L, i, &n);
+    lua_settop(L, _CM_WORK);
+    while(n > 0){
+        luaL_checkstack(L, 8, NULL);
+        lua_rawgeti(L, _CM_WORK, n);
+        lua_pushnil(L);
+        lua_rawseti(L, _CM_WORK, n--);
+        _cycle_trace(L, _CM_WORK + 1, &n);
+        lua_settop(L, _CM_WORK);
+    }
+    return 0;
+}
+
+static int _cycle_mark(lua_State *L, int nargs){
+    const int base = lua_gettop(L) - nargs;
+    lua_pushcfunction(L, _cycle_mark_client);
+    lua_insert(L, base + 1);
+    return lua_pcall(L, nargs, 0, 0);
+}
+
+static int _next_client(lua_State *L){
+    const int n = (int)lua_tointeger(L, 3);
+    int i, key = 2;
+    lua_settop(L, 2);
+    luaL_checkstack(L, 2 * n + 1, NULL);
+    for(i = 0; i < n; ++i){
+        lua_pushvalue(L, key);
+        if(!lua_next(L, 1))
+            break;
+        key = lua_gettop(L) - 1;
+    }
+    return lua_gettop(L) - 2;
+}
+
+static int _next_batch(lua_State *L, int n){
+    const int base = lua_gettop(L) - 2;
+    lua_pushcfunction(L, _next_client);
+    lua_insert(L, base + 1);
+    lua_pushinteger(L, n);
+    return lua_pcall(L, 3, LUA_MULTRET, 0);
+}
+
+/* deep conversion of nested tables. the walk writes one record per
+   value in depth first order. a table record is followed by its
+   values (arrays) or its key value pairs; its ``integer`` is the id of
+   the table, ``length`` the number of entries and ``isinteger`` the
+   flags. values which are not inlined are appended to a lua table,
+   and their records refer to them by index */
+#define _WALK_OBJECT 100
+#define _WALK_ARRAY 1
+#define _WALK_SEEN 2
+#define _WALK_OPEN 4
+
+typedef struct {
+    _stack_value *out;
+    size_t cap;
+    size_t n;
+    int maxdepth;
+    int mask;
+    int sequences;
+    int wrapcycles;
+    lua_Integer tables;
+} _walk_state;
+
+enum {_WALK_STATE = 2, _WALK_SEEN_TABLE, _WALK_OBJECTS};
+
+static _stack_value *_walk_emit(_walk_state *st){
+    static _stack_value dummy;
+    return st->n++ < st->cap ? &st->out[st->n - 1] : &dummy;
+}
+
+static void _walk_object(lua_State *L, int idx, _stack_value *r){
+    r->type = _WALK_OBJECT;
+    r->integer = (lua_Integer)lua_rawlen(L, _WALK_OBJECTS) + 1;
+    lua_pushvalue(L, idx);
+    lua_rawseti(L, _WALK_OBJECTS, r->integer);
+}
+
+static void _walk_value(lua_State *L, _walk_state *st, int idx, int depth, int iskey);
+
+static void _walk_table(lua_State *L, _walk_state *st, int idx, int depth, _stack_value *r){
+    lua_Integer id, n, count = 0;
+    int isarray, isnum;
+    lua_pushvalue(L, idx);
+    lua_rawget(L, _WALK_SEEN_TABLE);
+    if(!lua_isnil(L, -1)){
+        id = lua_tointeger(L, -1);
+        lua_pop(L, 1);
+        if(id < 0 && st->wrapcycles){
+            _walk_object(L, idx, r);
+        }else{
+            r->type = LUA_TTABLE;
+            r->isinteger = id > 0 ? _WALK_SEEN : _WALK_OPEN;
+            r->integer = id > 0 ? id : -id;
+        }
+        return;
+    }
+    lua_pop(L, 1);
+    id = ++st->tables;
+    lua_pushvalue(L, idx);
+    lua_pushinteger(L, -id);
+    lua_rawset(L, _WALK_SEEN_TABLE);
+    luaL_checkstack(L, 4, NULL);
+    n = (lua_Integer)lua_rawlen(L, idx);
+    isarray = st->sequences && n > 0;
+    lua_pushnil(L);
+    while(lua_next(L, idx)){
+        ++count;
+        if(isarray){
+            lua_Integer k = 0;
+            isnum = 0;
+            if(lua_type(L, -2) == LUA_TNUMBER)
+                k = lua_tointegerx(L, -2, &isnum);
+            if(!isnum || k < 1 || k > n || (lua_Number)k != lua_tonumber(L, -2))
+                isarray = 0;
+        }
+        lua_pop(L, 1);
+    }
+    isarray = isarray && count == n;
+    r->type = LUA_TTABLE;
+    r->isinteger = isarray ? _WALK_ARRAY : 0;
+    r->integer = id;
+    r->length = (size_t)count;
+    if(isarray){
+        lua_Integer i;
+        for(i = 1; i <= n; ++i){
+            lua_rawgeti(L, idx, i);
+            _walk_value(L, st, lua_gettop(L), depth, 0);
+            lua_pop(L, 1);
+        }
+    }else{
+        lua_pushnil(L);
+        while(lua_next(L, idx)){
+            _walk_value(L, st, lua_gettop(L) - 1, depth, 1);
+            _walk_value(L, st, lua_gettop(L), depth, 0);
+            lua_pop(L, 1);
+        }
+    }
+    lua_pushvalue(L, idx);
+    lua_pushinteger(L, id);
+    lua_rawset(L, _WALK_SEEN_TABLE);
+}
+
+static void _walk_value(lua_State *L, _walk_state *st, int idx, int depth, int iskey){
+    const int t = lua_type(L, idx);
+    _stack_value *r = _walk_emit(st);
+    if(t == LUA_TTABLE && !iskey && depth < st->maxdepth)
+        _walk_table(L, st, idx, depth + 1, r);
+    else if(t >= 0 && (st->mask & (1 << t))){
+        _peek_value(L, idx, r);
+        /* the record points into the string, so keep it alive as a key
+           of the objects table until the python side is done */
+        if(t == LUA_TSTRING){
+            lua_pushvalue(L, idx);
+            lua_pushboolean(L, 1);
+            lua_rawset(L, _WALK_OBJECTS);
+        }
+    }else
+        _walk_object(L, idx, r);
+}
+
+static int _walk_client(lua_State *L){
+    _walk_state *st = (_walk_state*)lua_touserdata(L, _WALK_STATE);
+    lua_settop(L, _WALK_STATE);
+    lua_newtable(L);
+    lua_newtable(L);
+    _walk_value(L, st, 1, 0, 0);
+    return 1;
+}
+
+static int _walk(lua_State *L, _walk_state *st){
+    const int base = lua_gettop(L) - 1;
+    lua_pushcfunction(L, _walk_client);
+    lua_insert(L, base + 1);
+    lua_pushlightuserdata(L, st);
+    return lua_pcall(L, 2, 1, 0);
+}
+
+static void _setlist(lua_State *L, lua_Integer start, int n){
+    const int t = lua_gettop(L) - n;
+    int i;
+    for(i = n; i >= 1; --i)
+        lua_rawseti(L, t, start + i - 1);
+}
+
+
+/* json. the decoder parses straight into lua values, the encoder
+   serializes lua values into a buffer kept in a userdata at a fixed
+   stack slot, so that nothing leaks when a lua error is raised */
+typedef struct {
+    const char *buf;
+    size_t len;
+    int null_sentinel;
+    int float_only;
+    int never_arrays;
+    int empty_array;
+    int strict_floats;
+} _json_state;
+
+#define _JSON_MAX_DEPTH 1000
+
+typedef struct {
+    const char *p;
+    const char *end;
+    const char *start;
+    const _json_state *st;
+} _json_decoder;
+
+static int _json_error(lua_State *L, _json_decoder *d, const char *msg){
+    return luaL_error(L, "%s at position %d", msg, (int)(d->p - d->start));
+}
+
+static void _json_skip(_json_decoder *d){
+    while(d->p < d->end && (*d->p == ' ' || *d->p == '\t' || *d->p == '\n' || *d->p == '\r'))
+        ++d->p;
+}
+
+static int _json_hex4(const char *p){
+    int i, v = 0;
+    for(i = 0; i < 4; ++i){
+        char c = p[i];
+        v <<= 4;
+        if(c >= '0' && c <= '9') v |= c - '0';
+        else if(c >= 'a' && c <= 'f') v |= c - 'a' + 10;
+        else if(c >= 'A' && c <= 'F') v |= c - 'A' + 10;
+        else return -1;
+    }
+    return v;
+}
+
+static void _json_add_utf8(luaL_Buffer *b, unsigned long c){
+    char s[4];
+    int n;
+    if(c < 0x80){ s[0] = (char)c; n = 1; }
+    else if(c < 0x800){ s[0] = (char)(0xC0 | (c >> 6)); s[1] = (char)(0x80 | (c & 0x3F)); n = 2; }
+    else if(c < 0x10000){ s[0] = (char)(0xE0 | (c >> 12)); s[1] = (char)(0x80 | ((c >> 6) & 0x3F)); s[2] = (char)(0x80 | (c & 0x3F)); n = 3; }
+    else{ s[0] = (char)(0xF0 | (c >> 18)); s[1] = (char)(0x80 | ((c >> 12) & 0x3F)); s[2] = (char)(0x80 | ((c >> 6) & 0x3F)); s[3] = (char)(0x80 | (c & 0x3F)); n = 4; }
+    luaL_addlstring(b, s, n);
+}
+
+static void _json_string(lua_State *L, _json_decoder *d){
+    const char *q = ++d->p;
+    luaL_Buffer b;
+    /* fast path without escapes */
+    while(q < d->end && *q != '"' && *q != '\\' && (unsigned char)*q >= 0x20)
+        ++q;
+    if(q < d->end && *q == '"'){
+        lua_pushlstring(L, d->p, q - d->p);
+        d->p = q + 1;
+        return;
+    }
+    luaL_buffinit(L, &b);
+    luaL_addlstring(&b, d->p, q - d->p);
+    d->p = q;
+    while(1){
+        char c;
+        if(d->p >= d->end)
+            _json_error(L, d, "unterminated string");
+        c = *d->p;
+        if(c == '"'){
+            ++d->p;
+            break;
+        }
+        if((unsigned char)c < 0x20)
+            _json_error(L, d, "control character in string");
+        if(c != '\\'){
+            luaL_addchar(&b, c);
+            ++d->p;
+            continue;
+        }
+        if(d->end - d->p < 2)
+            _json_error(L, d, "unterminated string");
+        c = d->p[1];
+        d->p += 2;
+        switch(c){
+        case '"': case '\\': case '/': luaL_addchar(&b, c); break;
+        case 'b': luaL_addchar(&b, '\b'); break;
+        case 'f': luaL_addchar(&b, '\f'); break;
+        case 'n': luaL_addchar(&b, '\n'); break;
+        case 'r': luaL_addchar(&b, '\r'); break;
+        case 't': luaL_addchar(&b, '\t'); break;
+        case 'u': {
+            long u = -1;
+            if(d->end - d->p < 4 || (u = _json_hex4(d->p)) < 0)
+                _json_error(L, d, "invalid unicode escape");
+            d->p += 4;
+            if(u >= 0xD800 && u < 0xDC00){
+                long lo = -1;
+                if(d->end - d->p < 6 || d->p[0] != '\\' || d->p[1] != 'u' ||
+                        (lo = _json_hex4(d->p + 2)) < 0xDC00 || lo >= 0xE000)
+                    _json_error(L, d, "invalid surrogate pair");
+                d->p += 6;
+                u = 0x10000 + ((u - 0xD800) << 10) + (lo - 0xDC00);
+            }else if(u >= 0xDC00 && u < 0xE000){
+                _json_error(L, d, "invalid surrogate pair");
+            }
+            _json_add_utf8(&b, (unsigned long)u);
+            break;
+        }
+        default:
+            d->p -= 2;
+            _json_error(L, d, "invalid escape");
+        }
+    }
+    luaL_pushresult(&b);
+}
+
+static void _json_number(lua_State *L, _json_decoder *d){
+    const char *p = d->p, *start = d->p;
+    int isfloat = 0;
+    char tmp[64], *buf = tmp, *endp;
+    size_t n;
+    if(p < d->end && *p == '-')
+        ++p;
+    if(p < d->end && *p == '0')
+        ++p;
+    else if(p < d->end && *p >= '1' && *p <= '9')
+        while(p < d->end && *p >= '0' && *p <= '9') ++p;
+    else
+        _json_error(L, d, "invalid number");
+    if(p < d->end && *p == '.'){
+        isfloat = 1;
+        ++p;
+        if(!(p < d->end && *p >= '0' && *p <= '9'))
+            _json_error(L, d, "invalid number");
+        while(p < d->end && *p >= '0' && *p <= '9') ++p;
+    }
+    if(p < d->end && (*p == 'e' || *p == 'E')){
+        isfloat = 1;
+        ++p;
+        if(p < d->end && (*p == '+' || *p == '-'))
+            ++p;
+        if(!(p < d->end && *p >= '0' && *p <= '9'))
+            _json_error(L, d, "invalid number");
+        while(p < d->end && *p >= '0' && *p <= '9') ++p;
+    }
+    /* the input isn't nul-terminated */
+    n = p - start;
+    if(n >= sizeof(tmp))
+        buf = (char*)lua_newuserdata(L, n + 1);
+    memcpy(buf, start, n);
+    buf[n] = '\0';
+    if(!isfloat && !d->st->float_only){
+        long long v;
+        errno = 0;
+        v = strtoll(buf, &endp, 10);
+        if(errno != ERANGE){
+            if(buf != tmp)
+                lua_pop(L, 1);
+            lua_pushinteger(L, (lua_Integer)v);
+            d->p = p;
+            return;
+        }
+    }
+    {
+        double v = strtod(buf, &endp);
+        if(buf != tmp)
+            lua_pop(L, 1);
+        lua_pushnumber(L, (lua_Number)v);
+    }
+    d->p = p;
+}
+
+static void _json_null(lua_State *L, const _json_state *st){
+    if(st->null_sentinel)
+        lua_pushlightuserdata(L, NULL);
+    else
+        lua_pushnil(L);
+}
+
+static void _json_value(lua_State *L, _json_decoder *d, int depth);
+
+static void _json_literal(lua_State *L, _json_decoder *d, const char *word, size_t n){
+    if((size_t)(d->end - d->p) < n || memcmp(d->p, word, n) != 0)
+        _json_error(L, d, "invalid value");
+    d->p += n;
+}
+
+static void _json_value(lua_State *L, _json_decoder *d, int depth){
+    _json_skip(d);
+    if(d->p >= d->end)
+        _json_error(L, d, "unexpected end of input");
+    switch(*d->p){
+    case '{': {
+        int t;
+        if(depth >= _JSON_MAX_DEPTH)
+            _json_error(L, d, "nested too deep");
+        luaL_checkstack(L, 4, NULL);
+        ++d->p;
+        lua_newtable(L);
+        t = lua_gettop(L);
+        _json_skip(d);
+        if(d->p < d->end && *d->p == '}'){
+            ++d->p;
+            return;
+        }
+        while(1){
+            _json_skip(d);
+            if(d->p >= d->end || *d->p != '"')
+                _json_error(L, d, "expected string key");
+            _json_string(L, d);
+            _json_skip(d);
+            if(d->p >= d->end || *d->p != ':')
+                _json_error(L, d, "expected ':'");
+            ++d->p;
+            _json_value(L, d, depth + 1);
+            lua_rawset(L, t);
+            _json_skip(d);
+            if(d->p < d->end && *d->p == ','){
+                ++d->p;
+                continue;
+            }
+            if(d->p < d->end && *d->p == '}'){
+                ++d->p;
+                return;
+            }
+            _json_error(L, d, "expected ',' or '}'");
+        }
+    }
+    case '[': {
+        int t;
+        lua_Integer i = 0;
+        if(depth >= _JSON_MAX_DEPTH)
+            _json_error(L, d, "nested too deep");
+        luaL_checkstack(L, 4, NULL);
+        ++d->p;
+        lua_newtable(L);
+        t = lua_gettop(L);
+        _json_skip(d);
+        if(d->p < d->end && *d->p == ']'){
+            ++d->p;
+            return;
+        }
+        while(1){
+            _json_value(L, d, depth + 1);
+            lua_rawseti(L, t, ++i);
+            _json_skip(d);
+            if(d->p < d->end && *d->p == ','){
+                ++d->p;
+                continue;
+            }
+            if(d->p < d->end && *d->p == ']'){
+                ++d->p;
+                return;
+            }
+            _json_error(L, d, "expected ',' or ']'");
+        }
+    }
+    case '"':
+        _json_string(L, d);
+        return;
+    case 't':
+        _json_literal(L, d, "true", 4);
+        lua_pushboolean(L, 1);
+        return;
+    case 'f':
+        _json_literal(L, d, "false", 5);
+        lua_pushboolean(L, 0);
+        return;
+    case 'n':
+        _json_literal(L, d, "null", 4);
+        _json_null(L, d->st);
+        return;
+    default:
+        _json_number(L, d);
+    }
+}
+
+static int _json_decode_client(lua_State *L){
+    const _json_state *st = (const _json_state*)lua_touserdata(L, 1);
+    _json_decoder d;
+    d.p = d.start = st->buf;
+    d.end = st->buf + st->len;
+    d.st = st;
+    _json_value(L, &d, 0);
+    _json_skip(&d);
+    if(d.p != d.end)
+        _json_error(L, &d, "extra data");
+    return 1;
+}
+
+static int _json_decode(lua_State *L, const _json_state *st){
+    lua_pushcfunction(L, _json_decode_client);
+    lua_pushlightuserdata(L, (void*)st);
+    return lua_pcall(L, 1, 1, 0);
+}
+
+enum {_JSON_VALUE = 1, _JSON_STATE, _JSON_BUFFER};
+
+typedef struct {
+    char *data;
+    size_t len;
+    size_t cap;
+} _json_buffer;
+
+static char *_json_reserve(lua_State *L, _json_buffer *b, size_t n){
+    if(b->cap - b->len < n){
+        size_t cap = b->cap * 2;
+        char *data;
+        while(cap - b->len < n)
+            cap *= 2;
+        data = (char*)lua_newuserdata(L, cap);
+        memcpy(data, b->data, b->len);
+        lua_replace(L, _JSON_BUFFER);
+        b->data = data;
+        b->cap = cap;
+    }
+    return b->data + b->len;
+}
+
+static void _json_add(lua_State *L, _json_buffer *b, const char *s, size_t n){
+    memcpy(_json_reserve(L, b, n), s, n);
+    b->len += n;
+}
+
+static void _json_add_string(lua_State *L, _json_buffer *b, const char *s, size_t n){
+    static const char hex[] = "0123456789abcdef";
+    size_t i;
+    /* at most 6 bytes per byte, and the quotes */
+    char *out = _json_reserve(L, b, n * 6 + 2), *o = out;
+    *o++ = '"';
+    for(i = 0; i < n; ++i){
+        unsigned char c = (unsigned char)s[i];
+        switch(c){
+        case '"': *o++ = '\\'; *o++ = '"'; break;
+        case '\\': *o++ = '\\'; *o++ = '\\'; break;
+        case '\n': *o++ = '\\'; *o++ = 'n'; break;
+        case '\r': *o++ = '\\'; *o++ = 'r'; break;
+        case '\t': *o++ = '\\'; *o++ = 't'; break;
+        case '\b': *o++ = '\\'; *o++ = 'b'; break;
+        case '\f': *o++ = '\\'; *o++ = 'f'; break;
+        default:
+            if(c < 0x20){
+                *o++ = '\\'; *o++ = 'u'; *o++ = '0'; *o++ = '0';
+                *o++ = hex[c >> 4]; *o++ = hex[c & 15];
+            }else{
+                *o++ = (char)c;
+            }
+        }
+    }
+    *o++ = '"';
+    b->len += o - out;
+}
+
+static void _json_add_number(lua_State *L, _json_buffer *b, int idx, int strict, int quoted){
+    char s[64];
+    int n;
+#if LUA_VERSION_NUM >= 503
+    if(lua_isinteger(L, idx)){
+        n = snprintf(s, sizeof(s), quoted ? "\"" LUA_INTEGER_FMT "\"" : LUA_INTEGER_FMT, (LUAI_UACINT)lua_tointeger(L, idx));
+        _json_add(L, b, s, n);
+        return;
+    }
+#endif
+    {
+        double v = (double)lua_tonumber(L, idx);
+        if(v != v || v == HUGE_VAL || v == -HUGE_VAL)
+            luaL_error(L, "cannot encode %s", v != v ? "nan" : "inf");
+        /* the shortest of these which reads back the same */
+        n = snprintf(s + 1, sizeof(s) - 4, "%.15g", v);
+        if(strtod(s + 1, NULL) != v)
+            n = snprintf(s + 1, sizeof(s) - 4, "%.16g", v);
+        if(strtod(s + 1, NULL) != v)
+            n = snprintf(s + 1, sizeof(s) - 4, "%.17g", v);
+        if(strict && !strpbrk(s + 1, ".eEn")){
+            s[1 + n++] = '.';
+            s[1 + n++] = '0';
+        }
+        if(quoted){
+            s[0] = '"';
+            s[1 + n++] = '"';
+            _json_add(L, b, s, n + 1);
+        }else{
+            _json_add(L, b, s + 1, n);
+        }
+    }
+}
+
+static void _json_encode_value(lua_State *L, _json_buffer *b, const _json_state *st, int idx, int depth);
+
+static void _json_encode_table(lua_State *L, _json_buffer *b, const _json_state *st, int idx, int depth){
+    lua_Integer n, count = 0;
+    int isarray, isnum, first = 1;
+    if(depth >= _JSON_MAX_DEPTH)
+        luaL_error(L, "nested too deep or contains a cycle");
+    luaL_checkstack(L, 4, NULL);
+    n = (lua_Integer)lua_rawlen(L, idx);
+    isarray = !st->never_arrays;
+    lua_pushnil(L);
+    while(lua_next(L, idx)){
+        ++count;
+        if(isarray){
+            lua_Integer k = 0;
+            isnum = 0;
+            if(lua_type(L, -2) == LUA_TNUMBER)
+                k = lua_tointegerx(L, -2, &isnum);
+            if(!isnum || k < 1 || k > n || (lua_Number)k != lua_tonumber(L, -2))
+                isarray = 0;
+        }
+        lua_pop(L, 1);
+    }
+    if(count == 0){
+        if(st->empty_array)
+            _json_add(L, b, "[]", 2);
+        else
+            _json_add(L, b, "{}", 2);
+        return;
+    }
+    if(isarray && count == n){
+        lua_Integer i;
+        _json_add(L, b, "[", 1);
+        for(i = 1; i <= n; ++i){
+            if(i > 1)
+                _json_add(L, b, ",", 1);
+            lua_rawgeti(L, idx, i);
+            _json_encode_value(L, b, st, lua_gettop(L), depth + 1);
+            lua_pop(L, 1);
+        }
+        _json_add(L, b, "]", 1);
+        return;
+    }
+    _json_add(L, b, "{", 1);
+    lua_pushnil(L);
+    while(lua_next(L, idx)){
+        if(!first)
+            _json_add(L, b, ",", 1);
+        first = 0;
+        switch(lua_type(L, -2)){
+        case LUA_TSTRING: {
+            size_t len;
+            const char *s = lua_tolstring(L, -2, &len);
+            _json_add_string(L, b, s, len);
+            break;
+        }
+        case LUA_TNUMBER:
+            _json_add_number(L, b, lua_gettop(L) - 1, 0, 1);
+            break;
+        default:
+            luaL_error(L, "cannot encode a %s key", luaL_typename(L, -2));
+        }
+        _json_add(L, b, ":", 1);
+        _json_encode_value(L, b, st, lua_gettop(L), depth + 1);
+        lua_pop(L, 1);
+    }
+    _json_add(L, b, "}", 1);
+}
+
+static void _json_encode_value(lua_State *L, _json_buffer *b, const _json_state *st, int idx, int depth){
+    switch(lua_type(L, idx)){
+    case LUA_TNIL:
+        _json_add(L, b, "null", 4);
+        break;
+    case LUA_TBOOLEAN:
+        if(lua_toboolean(L, idx))
+            _json_add(L, b, "true", 4);
+        else
+            _json_add(L, b, "false", 5);
+        break;
+    case LUA_TNUMBER:
+        _json_add_number(L, b, idx, st->strict_floats, 0);
+        break;
+    case LUA_TSTRING: {
+        size_t len;
+        const char *s = lua_tolstring(L, idx, &len);
+        _json_add_string(L, b, s, len);
+        break;
+    }
+    case LUA_TTABLE:
+        _json_encode_table(L, b, st, idx, depth);
+        break;
+    case LUA_TLIGHTUSERDATA:
+        if(lua_touserdata(L, idx) == NULL){
+            _json_add(L, b, "null", 4);
+            break;
+        }
+        /* fall through */
+    default:
+        luaL_error(L, "cannot encode a %s", luaL_typename(L, idx));
+    }
+}
+
+static int _json_encode_client(lua_State *L){
+    const _json_state *st = (const _json_state*)lua_touserdata(L, _JSON_STATE);
+    _json_buffer b;
+    lua_settop(L, _JSON_STATE);
+    b.len = 0;
+    b.cap = 256;
+    b.data = (char*)lua_newuserdata(L, b.cap);
+    _json_encode_value(L, &b, st, _JSON_VALUE, 0);
+    lua_pushlstring(L, b.data, b.len);
+    return 1;
+}
+
+static int _json_encode(lua_State *L, const _json_state *st){
+    lua_pushcfunction(L, _json_encode_client);
+    lua_insert(L, -2);
+    lua_pushlightuserdata(L, (void*)st);
+    return lua_pcall(L, 2, 1, 0);
+}
+
+
+/* identity cache of pushed python objects. it's a weak-valued table in
+   the registry, mapping the address of an object to its userdata. lua
+   clears weak values before running finalizers, so an entry never
+   outlives the handle keeping the object alive */
+static const char _pycache_key = 0;
+
+int _pycache_get(lua_State *L, intptr_t id){
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_pycache_key);
+    if(lua_isnil(L, -1)){
+        lua_pop(L, 1);
+        return 0;
+    }
+    lua_rawgetp(L, -1, (void*)id);
+    lua_remove(L, -2);
+    if(lua_isnil(L, -1)){
+        lua_pop(L, 1);
+        return 0;
+    }
+    return 1;
+}
+
+void _pycache_set(lua_State *L, intptr_t id){
+    lua_rawgetp(L, LUA_REGISTRYINDEX, &_pycache_key);
+    if(lua_isnil(L, -1)){
+        lua_pop(L, 1);
+        lua_newtable(L);
+        lua_createtable(L, 0, 1);
+        lua_pushliteral(L, "v");
+        lua_setfield(L, -2, "__mode");
+        lua_setmetatable(L, -2);
+        lua_pushvalue(L, -1);
+        lua_rawsetp(L, LUA_REGISTRYINDEX, &_pycache_key);
+    }
+    lua_pushvalue(L, -2);
+    lua_rawsetp(L, -2, (void*)id);
+    lua_pop(L, 1);
+}
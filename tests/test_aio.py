@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+from ffilupa import *
+from ffilupa.aio import *
+from ffilupa.py_from_lua import LuaThread
+
+
+lua = LuaRuntime()
+lua.execute('''
+function fetch(sleep, n)
+    local total = 0
+    for i = 1, n do
+        total = total + coroutine.yield(sleep(0.01, i))
+    end
+    return total
+end
+function gen(sleep)
+    coroutine.yield(1)
+    local x = coroutine.yield(sleep(0, 'awd'))
+    coroutine.yield(x)
+    return 'end'
+end
+''')
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+def sleep(delay, result):
+    return asyncio.sleep(delay, result)
+
+
+def test_drive():
+    assert run(drive(lua._G.fetch.coroutine(sleep, 3))) == 6
+    assert run(drive(lua.eval('function() end').coroutine())) is None
+
+
+def test_await_and_task():
+    async def main():
+        threads = [lua._G.fetch.coroutine(sleep, i) for i in range(20)]
+        tasks = [create_task(t) for t in threads[1:]]
+        return [await threads[0]] + list(await asyncio.gather(*tasks))
+    assert run(main()) == [i * (i + 1) // 2 for i in range(20)]
+
+
+def test_iterate():
+    async def main():
+        return [x async for x in lua._G.gen.coroutine(sleep)]
+    assert run(main()) == [1, 'awd', 'end']
+
+
+def test_exception():
+    async def fail(delay, i):
+        raise KeyError(i)
+    co = lua._G.fetch.coroutine(fail, 1)
+    with pytest.raises(KeyError):
+        run(drive(co))
+    assert co.status() == 'suspended'
+
+
+def test_yield_lua_coroutine():
+    outer = 'function() coroutine.yield(coroutine.create(function() end)) return "outer-done" end'
+    rv = list(lua.eval(outer).coroutine())
+    assert isinstance(rv[0], LuaThread) and rv[1:] == ['outer-done']
+
+    async def main():
+        return [x async for x in lua.eval(outer).coroutine()]
+    rv = run(main())
+    assert isinstance(rv[0], LuaThread) and rv[1:] == ['outer-done']
+    assert run(drive(lua.eval(outer).coroutine())) == 'outer-done'
@@ -0,0 +1,58 @@
+import os
+import pytest
+from ffilupa import *
+
+
+def write(path, code):
+    with open(path, 'w') as f:
+        f.write(code)
+
+
+def test_compile_path(tmpdir):
+    cache = BytecodeCache()
+    path = str(tmpdir.join('m.lua'))
+    write(path, 'return "awd"')
+    with LuaRuntime(bytecode_cache=cache) as lua:
+        cpath = cache.cache_path(lua, path)
+        assert not os.path.exists(cpath)
+        assert lua.compile_path(path)() == 'awd'
+        assert os.path.dirname(cpath).endswith(b'__luacache__')
+        with open(cpath, 'rb') as f:
+            assert f.read(4) == BytecodeCache.MAGIC
+        assert lua.compile_path(path)() == 'awd'
+        st = os.stat(path)
+        write(path, 'return "dwa"')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        assert lua.compile_path(path)() == 'dwa'
+        write(path, 'return "awd')
+        with pytest.raises(LuaErrSyntax):
+            lua.compile_path(path)
+
+
+def test_cached_bytecode_is_used(tmpdir):
+    cache = BytecodeCache(str(tmpdir.join('cache')), strip=True)
+    path = str(tmpdir.join('m.lua'))
+    write(path, 'return "awd"')
+    with LuaRuntime(bytecode_cache=cache) as lua:
+        lua.compile_path(path)
+        cpath = cache.cache_path(lua, path)
+        assert cpath.startswith(os.fsencode(str(tmpdir.join('cache'))))
+        with open(cpath, 'rb') as f:
+            data = f.read()
+        with open(cpath, 'wb') as f:
+            f.write(data.replace(b'awd', b'dwa'))
+        assert lua.compile_path(path)() == 'dwa'
+        with open(cpath, 'wb') as f:
+            f.write(data[:BytecodeCache._header.size] + b'garbage')
+        assert lua.compile_path(path)() == 'awd'
+
+
+def test_require(tmpdir):
+    cache = BytecodeCache()
+    write(str(tmpdir.join('awdmod.lua')), 'return {name = ...}')
+    with LuaRuntime(bytecode_cache=cache) as lua:
+        lua._G.package.path = str(tmpdir.join('?.lua'))
+        assert lua.eval('require("awdmod").name') == 'awdmod'
+        assert os.path.exists(cache.cache_path(lua, str(tmpdir.join('awdmod.lua'))))
+        with pytest.raises(LuaErrRun, match='no file'):
+            lua.eval('require("nosuchmod")')
@@ -0,0 +1,35 @@
+import os
+import pytest
+from ffilupa import *
+
+
+PRELUDE = '''
+mod = {}
+function mod.add(a, b) return a + b end
+function mod.pid() return python.eval('__import__("os").getpid()') end
+function mod.info(s) return {name = s, n = #s}, true end
+function mod.fail() error('awd') end
+function mod.func() return function() end end
+'''
+
+
+def test_submit_map():
+    with LuaProcessExecutor(2, PRELUDE) as ex:
+        assert ex.submit('mod.add', 1, 2).result() == 3
+        assert list(ex.map('mod.add', range(10), range(10))) == list(range(0, 20, 2))
+        assert ex.submit('mod.info', 'awd').result() == ({'name': 'awd', 'n': 3}, True)
+        assert ex.submit('mod.pid').result() != os.getpid()
+        with pytest.raises(LuaErrRun, match='awd'):
+            ex.submit('mod.fail').result()
+        with pytest.raises(TypeError):
+            ex.submit('mod.func').result()
+        assert ex.submit('mod.add', 2, 3).result() == 5
+
+
+def test_recycle():
+    with LuaProcessExecutor(1, PRELUDE, max_tasks_per_worker=2) as ex:
+        pids = [ex.submit('mod.pid').result() for _ in range(6)]
+        assert len(set(pids)) == 3
+    with LuaProcessExecutor(1, PRELUDE, max_memory=1) as ex:
+        pids = [ex.submit('mod.pid').result() for _ in range(3)]
+        assert len(set(pids)) == 3
@@ -0,0 +1,192 @@
+import asyncio
+import gc
+import weakref
+import threading
+import time
+import pytest
+from ffilupa import *
+from ffilupa.luagc import GCStats, IdleCollector
+
+
+def test_collect_and_stats():
+    lua = LuaRuntime()
+    before = lua.gc.stats()
+    assert isinstance(before, GCStats)
+    lua.execute('junk = {} for i = 1, 10000 do junk[i] = {} end')
+    grown = lua.gc.count()
+    assert grown > before.kbytes
+    lua.execute('junk = nil')
+    lua.gc.collect()
+    after = lua.gc.stats()
+    assert after.kbytes < grown
+    assert after.collections > before.collections
+    assert lua.gc.count() == pytest.approx(lua.eval('collectgarbage("count")'), abs=1)
+
+
+def test_stop_restart_step():
+    lua = LuaRuntime()
+    lua.gc.stop()
+    assert not lua.gc.isrunning()
+    assert lua.eval('collectgarbage("isrunning")') is False
+    lua.gc.restart()
+    assert lua.gc.isrunning()
+    lua.execute('for i = 1, 1000 do local t = {} end')
+    cycles = lua.gc.stats().collections
+    while not lua.gc.step(1024):
+        pass
+    assert lua.gc.stats().collections >= cycles
+
+
+def test_tuning():
+    lua = LuaRuntime()
+    old = lua.gc.setpause(150)
+    assert lua.gc.setpause(old) == 150
+    old = lua.gc.setstepmul(300)
+    assert lua.gc.setstepmul(old) == 300
+
+
+def test_generational():
+    lua = LuaRuntime()
+    if lua.gc.supports_generational:
+        lua.gc.generational()
+        lua.gc.incremental()
+    else:
+        with pytest.raises(NotImplementedError):
+            lua.gc.generational()
+        with pytest.raises(NotImplementedError):
+            lua.gc.incremental()
+
+
+def test_collect_gc_error():
+    lua = LuaRuntime()
+    lua.execute('setmetatable({}, {__gc = function() error("awd") end})')
+    with pytest.raises(LuaErr, match='awd'):
+        lua.gc.collect()
+    lua.gc.collect()
+
+
+def test_idle_collector_tick():
+    lua = LuaRuntime()
+    old = lua.gc.setpause(200)
+    idle = lua.gc.idle(step_time=1)
+    idle._activate()
+    assert lua.gc.setpause(400) == 400
+    lua.execute('for i = 1, 10000 do local t = {} end')
+    cycles = lua.gc.stats().collections
+    assert idle.tick()
+    assert lua.gc.stats().collections > cycles
+    assert idle.steps >= 1 and idle.ticks == 1
+    steps = idle.steps
+    assert idle.tick()
+    assert idle.steps == steps
+    idle.stop()
+    assert not idle.active
+    assert lua.gc.setpause(old) == 200
+
+
+def test_idle_collector_skips_busy():
+    lua = LuaRuntime()
+    idle = IdleCollector(lua, interval=0.001)
+    done = threading.Event()
+    with lua.lock():
+        t = threading.Thread(target=lambda: (idle.tick(), done.set()))
+        t.start()
+        done.wait()
+    t.join()
+    assert idle.skipped == 1 and idle.ticks == 0
+
+
+def test_idle_collector_thread():
+    lua = LuaRuntime()
+    with lua.gc.idle(interval=0.001) as idle:
+        idle.start()
+        with pytest.raises(RuntimeError):
+            idle.start()
+        lua.execute('for i = 1, 10000 do local t = {} end')
+        deadline = time.monotonic() + 5
+        while not idle.ticks and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert idle.ticks
+    assert not idle.active
+    with pytest.raises(ValueError):
+        LuaRuntime(threadsafe=False).gc.idle().start()
+
+
+def test_idle_collector_asyncio():
+    lua = LuaRuntime()
+
+    async def main():
+        idle = lua.gc.idle(interval=0.001)
+        idle.attach()
+        lua.execute('for i = 1, 10000 do local t = {} end')
+        for _ in range(100):
+            await asyncio.sleep(0.005)
+            if idle.ticks:
+                break
+        idle.stop()
+        return idle.ticks
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+class Box:
+    pass
+
+
+def test_collect_cycles():
+    lua = LuaRuntime()
+
+    def make():
+        t = lua.table()
+        b = Box()
+        b.t = t
+        t.b = b
+        t.f = lambda: t
+        return weakref.ref(b)
+
+    ref = make()
+    gc.collect()
+    assert ref() is not None
+    refs = len(lua.refs)
+    assert lua.gc.collect_cycles() == 1
+    gc.collect()
+    assert ref() is None
+    assert len(lua.refs) == refs - 2
+
+
+def test_collect_cycles_keeps_reachable():
+    lua = LuaRuntime()
+    lua.execute('co = coroutine.create(function(x) coroutine.yield() return x end)')
+
+    def make(root):
+        t = lua.table()
+        b = Box()
+        b.t = t
+        t.b = b
+        root(t)
+        return weakref.ref(b)
+
+    held = make(lambda t: None)
+    held_box = held()
+    globaled = make(lambda t: lua._G.__setitem__('g', t))
+    upvalued = make(lua.eval('function(t) function getter() return t end end'))
+    threaded = make(lambda t: lua.eval('coroutine.resume')(lua._G.co, t))
+    gc.collect()
+    assert lua.gc.collect_cycles() == 0
+    gc.collect()
+    for ref in (held, globaled, upvalued, threaded):
+        assert ref() is not None
+    assert held_box.t.b is held_box
+    assert lua.eval('g').b is globaled()
+    assert lua.eval('getter()').b is upvalued()
+    assert lua._G.co.send(None).b is threaded()
+
+
+def test_collect_cycles_lua_running():
+    lua = LuaRuntime()
+    with pytest.raises(RuntimeError):
+        lua.eval('function(f) return f() end')(lua.gc.collect_cycles)
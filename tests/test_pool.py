@@ -0,0 +1,60 @@
+import threading
+import pytest
+from ffilupa import *
+
+
+def test_checkout_reset():
+    with LuaRuntimePool(2, 'greeting = "awd"; counter = 0') as pool:
+        with pool.checkout() as lua:
+            assert lua.eval('greeting') == 'awd'
+            lua.execute('greeting = "dwa"; junk = {}; string.junk = 1; counter = counter + 1')
+            lua.execute('package.loaded.junkmod = true')
+        stats = pool.stats()
+        assert stats.checkouts == 1 and stats.resets == 1 and stats.idle == 2
+        for _ in range(2):
+            with pool.checkout() as lua:
+                assert lua.eval('greeting') == 'awd'
+                assert lua.eval('junk') is None
+                assert lua.eval('string.junk') is None
+                assert lua.eval('package.loaded.junkmod') is None
+                assert lua.eval('counter') == 0
+                assert lua.eval('string.format("%d", 1)') == '1'
+
+
+def test_prelude_callable_and_timeout():
+    def prelude(lua):
+        lua._G.awd = 'dwa'
+    pool = LuaRuntimePool(1, prelude, reset=False)
+    lua = pool.acquire()
+    assert lua.eval('awd') == 'dwa'
+    with pytest.raises(TimeoutError):
+        pool.acquire(timeout=0.01)
+    lua.execute('awd = 1')
+    pool.release(lua)
+    with pool.checkout() as lua2:
+        assert lua2 is lua
+        assert lua.eval('awd') == 1
+    pool.close()
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+
+def test_threads():
+    pool = LuaRuntimePool(2, 'n = 0')
+    results = []
+    def work():
+        for _ in range(20):
+            with pool.checkout() as lua:
+                lua.execute('n = n + 1')
+                results.append(lua.eval('n'))
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [1] * 80
+    stats = pool.stats()
+    assert stats.checkouts == stats.resets == 80
+    assert 0 < stats.utilization <= 1
+    assert stats.wait_time >= stats.max_wait >= 0
+    pool.close()
@@ -4,6 +4,7 @@ import pytest
 import semantic_version as sv
 from ffilupa import *
 from ffilupa.py_from_lua import *
+from ffilupa.util import *
 
 
 lua = LuaRuntime()
@@ -135,6 +136,92 @@ def test_table_iter_and_abc():
     assert 'dog' not in tb
 
 
+def test_table_iter_batched():
+    tb = lua.eval('(function() local t = {} for i = 1, 100 do t[i] = {i} end return t end)()')
+    for batch_size in (1, 7, 50, 100, 1000):
+        it = LuaKVIter(tb, batch_size)
+        assert it._info is None
+        items = sorted(it)
+        assert [k for k, _ in items] == list(range(1, 101))
+        assert [v[1] for _, v in items] == list(range(1, 101))
+        with pytest.raises(StopIteration):
+            next(it)
+    assert list(LuaKIter(lua.table(), 1)) == []
+    stack_top = lua.lib.lua_gettop(lua.lua_state)
+    with pytest.raises(LuaErr, match='next'):
+        it = LuaKIter(lua.table(a=1, b=2), 1)
+        next(it)
+        it._key = lua.table()
+        next(it)
+    assert lua.lib.lua_gettop(lua.lua_state) == stack_top
+
+
+def test_table_iter_pairs():
+    tb = lua.eval('setmetatable({}, {__pairs = function(t) return next, {a = 1, b = 2}, nil end})')
+    it = iter(tb.items())
+    assert it._info is not None
+    assert sorted(it) == [('a', 1), ('b', 2)]
+
+
+def test_table_to_python():
+    tb = lua.eval('''{
+        name = "awd", list = {1, 2.5, {x = "y"}}, empty = {}, [1.5] = true,
+        f = print, holes = {1, nil, 3}, raw = "\\xff",
+    }''')
+    d = tb.to_python(autodecode=False, keys='str')
+    assert d['name'] == b'awd'
+    assert d['list'] == [1, 2.5, {'x': b'y'}]
+    assert d['empty'] == {}
+    assert d[1.5] is True
+    assert isinstance(d['f'], LuaFunction)
+    assert d['holes'] == {1: 1, 3: 3}
+    assert d['raw'] == b'\xff'
+    assert set(tb.to_python(keys='bytes', autodecode=False)) == {b'name', b'list', b'empty', 1.5, b'f', b'holes', b'raw'}
+    assert tb.to_python(sequence=tuple, keys='auto', autodecode=False)['list'] == (1, 2.5, {'x': b'y'})
+    assert tb.to_python(sequence=None, keys='str', autodecode=False)['list'] == {1: 1, 2: 2.5, 3: {'x': b'y'}}
+    shallow = tb.to_python(deep=False, keys='str', autodecode=False)
+    assert isinstance(shallow['list'], LuaTable)
+    assert isinstance(tb.to_python(max_depth=2, keys='str', autodecode=False)['list'][2], LuaTable)
+    assert tb.to_python(keys='str', autodecode=False, on_object=lambda o: 'object')['f'] == 'object'
+    with pytest.raises(UnicodeDecodeError):
+        tb.to_python()
+
+
+def test_table_to_python_shared_and_cycles():
+    tb = lua.eval('(function() local s = {1} local c = {} c.c = c return {a = s, b = s, c = c} end)()')
+    with pytest.raises(ValueError, match='itself'):
+        tb.to_python()
+    d = tb.to_python(on_cycle='share')
+    assert d['a'] is d['b']
+    assert d['c']['c'] is d['c']
+    assert tb.to_python(on_cycle='none')['c'] == {'c': None}
+    assert isinstance(tb.to_python(on_cycle='wrap')['c']['c'], LuaTable)
+    with pytest.raises(ValueError):
+        tb.to_python(on_cycle='awd')
+
+
+def test_table_to_python_large():
+    tb = lua.eval('(function() local t = {} for i = 1, 1000 do t[i] = {name = "n" .. i, vals = {i, i + 1}} end return t end)()')
+    rv = tb.to_python()
+    assert len(rv) == 1000
+    assert rv[41] == {'name': 'n42', 'vals': [42, 43]}
+
+
+def test_table_to_python_strings_survive_on_object():
+    tb = lua.eval('(function() local s = {} for i = 1, 200 do s[i] = ("s" .. i):rep(50) end return {print, s} end)()')
+    clear = lua.eval('''function(t)
+        for i = 1, 200 do t[2][i] = nil end
+        collectgarbage() collectgarbage()
+        local junk = {} for i = 1, 200 do junk[i] = ("z" .. i):rep(50) end
+    end''')
+
+    def on_object(o):
+        clear(tb)
+        return o
+    d = tb.to_python(on_object=on_object)
+    assert d[1] == [('s%d' % i) * 50 for i in range(1, 201)]
+
+
 def test_traceback_nil():
     f = lua.eval('function() return "awd" end')
     g = lua.eval('function() error("awd") end')
@@ -152,6 +239,44 @@ def test_traceback_nil():
     lua._G.debug.traceback = tb
 
 
+def test_traceback_replaced():
+    g = lua.eval('function() error("awd") end')
+    tb = lua._G.debug.traceback
+    lua._G.debug.traceback = lambda msg: msg + ' dwa'
+    try:
+        with pytest.raises(LuaErrRun, match='^python:1: awd dwa$'):
+            g()
+        lua.execute('debug.traceback = function(msg, ...) return msg .. " " .. select("#", ...) end')
+        with pytest.raises(LuaErrRun, match='^python:1: awd 0$'):
+            g()
+    finally:
+        lua._G.debug.traceback = tb
+    with pytest.raises(LuaErrRun, match='stack traceback:'):
+        g()
+
+
+def test_call_stack_balance():
+    f = lua.eval('function(...) return ... end')
+    g = lua.eval('function() error("awd") end')
+    with lock_get_state(lua) as L:
+        top = lua.lib.lua_gettop(L)
+        assert f(1, 2, 3) == (1, 2, 3)
+        with pytest.raises(LuaErrRun):
+            g()
+        assert lua.lib.lua_gettop(L) == top
+
+
+def test_registry_ref():
+    tb = lua.table(awd='dwa')
+    assert isinstance(tb._ref, int)
+    other = tb.pull(keep=True)
+    assert other._ref != tb._ref
+    assert other['awd'] == 'dwa'
+    assert lua.eval('function(a, b) return rawequal(a, b) end')(tb, other) is True
+    refs = {lua.table()._ref for _ in range(lua.release_threshold * 2)}
+    assert len(refs) < lua.release_threshold * 2
+
+
 def test_lua_number():
     i = lua._G.python.to_luaobject(1)
     f = lua._G.python.to_luaobject(1.1)
@@ -393,3 +518,73 @@ def test_index_fail():
     a.__class__ = LuaTable
     with pytest.raises(LuaErrRun):
         a['awd']
+
+
+def test_puller_table():
+    puller = std_puller.copy()
+    with LuaRuntime(puller=puller) as rt:
+        assert rt.eval('1') == 1
+        @puller.register('LUA_TNUMBER')
+        def _(runtime, obj, **kwargs):
+            return 'number'
+        assert rt.eval('1') == 'number'
+        del puller['LUA_TNUMBER']
+        assert isinstance(rt.eval('1'), LuaNumber)
+        puller.register_default(None)
+        with pytest.raises(TypeError, match="^cannot find puller for lua type"):
+            rt.eval('{}')
+    assert lua.eval('1') == 1
+
+
+def test_puller_by_value():
+    assert lua.eval('nil, 1, 1.5, 2^53, true, false, "a\\0b"') == \
+        (None, 1, 1.5, 2 ** 53, True, False, 'a\0b')
+    assert lua.eval('function() return "a\\0b" end')(autodecode=False) == b'a\0b'
+    puller = std_puller.copy()
+    with LuaRuntime(puller=puller) as rt:
+        @puller.register('LUA_TNUMBER', by_value=True)
+        def _(runtime, value, **kwargs):
+            return (value.isinteger, value.number)
+        @puller.register('LUA_TBOOLEAN')
+        def _(runtime, obj, **kwargs):
+            return type(obj).__name__
+        assert rt.eval('1.5') == (0, 1.5)
+        assert rt.eval('true') == 'LuaVolatile'
+
+
+def test_call_budget():
+    loop = lua.eval('function() while true do end end')
+    with pytest.raises(LuaErrBudget, match='^instruction limit exceeded$'):
+        loop(instruction_limit=100000)
+    with pytest.raises(LuaErrBudget, match='^time limit exceeded$'):
+        loop(time_limit=0.05)
+    swallow = lua.eval('function() while true do pcall(function() while true do end end) end end')
+    with pytest.raises(LuaErrBudget):
+        swallow(instruction_limit=10000)
+    count = lua.eval('function(n) local s = 0 for i = 1, n do s = s + i end return s end')
+    assert count(10, instruction_limit=1000) == 55
+    assert count(100000) == 5000050000
+    with LuaRuntime(instruction_limit=10000) as rt:
+        f = rt.eval('function(n) for i = 1, n do end return n end')
+        assert f(10) == 10
+        with pytest.raises(LuaErrBudget):
+            f(10 ** 6)
+        assert f(10 ** 6, instruction_limit=10 ** 8) == 10 ** 6
+        assert rt.eval('1 + 1') == 2
+    assert lua.eval('debug.gethook()') == (None, '', 0)
+
+
+def test_call_budget_nested():
+    outer = lua.eval('function(f) while true do f() end end')
+    inner = lua.eval('function() for i = 1, 1000 do end end')
+    with pytest.raises(LuaErrBudget, match='^instruction limit exceeded$'):
+        outer(lambda: inner(instruction_limit=10 ** 8), instruction_limit=100000)
+    loop = lua.eval('function() while true do end end')
+    with pytest.raises(LuaErrBudget, match='^time limit exceeded$'):
+        outer(lambda: loop(time_limit=60), time_limit=0.05)
+    with pytest.raises(LuaErrBudget, match='^instruction limit exceeded$'):
+        outer(lambda: loop(instruction_limit=10 ** 9), instruction_limit=100000)
+    protected = lua.eval('function(f) return (pcall(f)) end')
+    assert protected(lambda: inner(instruction_limit=100), instruction_limit=10 ** 8) is False
+    assert protected(lambda: inner(instruction_limit=10 ** 6), instruction_limit=10 ** 8) is True
+    assert lua.eval('debug.gethook()') == (None, '', 0)
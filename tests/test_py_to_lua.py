@@ -1,4 +1,6 @@
+import pytest
 from ffilupa import *
+from ffilupa.py_to_lua import std_pusher
 
 
 lua = LuaRuntime()
@@ -50,3 +52,80 @@ def test_push_bytes():
 def test_push_None():
     lua._G.n = None
     assert lua.eval('type(n)') == 'nil'
+
+
+def test_push_fast_override():
+    class MyInt(int):
+        pass
+    pusher = std_pusher.copy()
+    with LuaRuntime(pusher=pusher) as rt:
+        rt._G.n = MyInt(3)
+        assert rt.eval('math.type(n) == "integer" or type(n) == "number"')
+        @pusher.register(str)
+        def _(pi):
+            return pi.pusher.internal_push(pi.with_new_obj(b'AwD!'))
+        assert rt.eval('function(s) return s end')('awd') == 'AwD!'
+    lua._G.s = 'awd'
+    assert lua.eval('s') == 'awd'
+
+
+def test_push_deep():
+    f = lua.eval('function(t) return type(t), t end')
+    assert f({'a': 1})[0] == 'userdata'
+    tp, t = f({'a': [1, 2, ('x', {'b': True})]}, deep_push=True)
+    assert tp == 'table'
+    assert t.to_python() == {'a': [1, 2, ['x', {'b': True}]]}
+    assert lua.eval('function(t) return #t end')(list(range(1000)), deep_push=True) == 1000
+
+
+def test_push_deep_cycle_and_shared():
+    d = {'x': 1}
+    d['self'] = d
+    check = lua.eval('function(t) return t[1] == t[2] and t[1].self == t[1] and t[1].x == 1 end')
+    assert check([d, d], deep_push=True)
+
+
+def test_push_deep_limit_and_keys():
+    f = lua.eval('function(t) return t end')
+    top = lua.lib.lua_gettop(lua.lua_state)
+    with pytest.raises(ValueError, match='limit'):
+        f([[1, 2], [3, 4]], deep_push=True, deep_push_limit=5)
+    with pytest.raises(ValueError, match='nil'):
+        f({None: 1}, deep_push=True)
+    with pytest.raises(ValueError, match='nan'):
+        f({float('nan'): 1}, deep_push=True)
+    assert lua.lib.lua_gettop(lua.lua_state) == top
+    assert f([[1, 2], [3, 4]], deep_push=True, deep_push_limit=6).to_python() == [[1, 2], [3, 4]]
+
+
+def test_push_deep_runtime():
+    rt = LuaRuntime(deep_push=True, deep_push_limit=None)
+    rt._G.t = {'a': [1, 2]}
+    assert rt.eval('type(t.a) == "table" and t.a[2] == 2')
+    assert rt.eval('function(t) return type(t) end')({}, deep_push=False) == 'userdata'
+
+
+class _Obj:
+    pass
+
+
+def test_push_identity_cache():
+    rt = LuaRuntime()
+    o = _Obj()
+    same = rt.eval('function(a, b) local t = {[a] = 1} return a == b, rawequal(a, b), t[b] end')
+    assert same(o, o) == (True, True, 1)
+    rt.gc.collect()
+    refs = len(rt.refs)
+    rt._G.o = o
+    assert rt.eval('o') is o
+    rt._G.p = o
+    assert rt.eval('rawequal(o, p)')
+    assert len(rt.refs) == refs + 1
+    assert same(as_attrgetter(o), as_attrgetter(o))[1] is False
+    assert same(_Obj(), _Obj())[1] is False
+    rt.execute('o, p = nil, nil')
+    rt.gc.collect()
+    assert len(rt.refs) == refs
+    assert rt.eval('function(o) return o end')(o) is o
+    rt = LuaRuntime(identity_cache=False)
+    assert rt.eval('function(a, b) return rawequal(a, b) end')(o, o) is False
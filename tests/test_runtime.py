@@ -1,11 +1,14 @@
 import os
 import tempfile
+import threading
 from pathlib import Path
 import pytest
 from ffilupa import *
 from ffilupa.metatable import *
 from ffilupa.py_from_lua import *
 from ffilupa.py_to_lua import *
+from ffilupa.runtime import VoidLock
+from ffilupa.util import *
 
 
 lua = LuaRuntime()
@@ -236,3 +239,232 @@ def test_ffilupa():
 
 def test_runtime():
     assert lua.eval('python.runtime') is lua
+
+
+def test_release_queue():
+    with LuaRuntime() as rt:
+        rt.release_threshold = 4
+        tb = rt.table()
+        objs = [tb.pull(keep=True) for _ in range(6)]
+        refs = [obj._ref for obj in objs]
+        event, done = threading.Event(), threading.Event()
+        def hold():
+            with rt.lock():
+                event.set()
+                done.wait()
+        t = threading.Thread(target=hold)
+        t.start()
+        try:
+            event.wait()
+            del objs
+            assert sorted(rt._release_queue) == sorted(refs)
+        finally:
+            done.set()
+            t.join()
+        assert len(tb) == 0
+        assert rt._release_queue == []
+        objs = [tb.pull(keep=True) for _ in range(6)]
+        del objs
+        assert len(rt._release_queue) < rt.release_threshold
+
+
+def test_release_queue_void_lock():
+    with LuaRuntime(lock=VoidLock()) as rt:
+        rt.release_threshold = 4
+        tb = rt.table()
+        objs = [tb.pull(keep=True) for _ in range(4)]
+        del objs
+        assert rt._release_queue == []
+
+
+def test_push_many_pull_range():
+    t = lua.table(a=1)
+    objs = [1, 2.5, True, 'abc', b'a\0b', None, t, 1 << 70, lua.nil, False]
+    with lock_get_state(lua) as L:
+        with ensure_stack_balance(lua):
+            top = lua.lib.lua_gettop(L)
+            handles = lua.push_many(iter(objs))
+            assert len(handles) == len(objs)
+            assert lua.lib.lua_gettop(L) == top + len(objs)
+            rv = lua.pull_range(top + 1, top + len(objs) + 1, autodecode=False)
+    assert rv[:6] == [1, 2.5, True, b'abc', b'a\0b', None]
+    assert rv[6] == t
+    assert int(rv[7]) == 1 << 70
+    assert rv[8:] == [None, False]
+    assert lua.pull_range(3, 3) == []
+    f = lua.eval('function(...) return select("#", ...), ... end')
+    args = list(range(500))
+    assert f(*args) == tuple([500] + args)
+
+
+def test_compile_cache():
+    with LuaRuntime(compile_cache_size=2) as rt:
+        rt.compile_cache.clear()
+        hits, misses, evictions, _, _ = rt.compile_cache.info()
+        assert rt.eval('1 + 1') == 2
+        assert rt.eval('1 + 1') == 2
+        assert rt.compile_cache.info() == CacheInfo(hits + 1, misses + 1, evictions, 2, 1)
+        rt.compile('return 1', b'=a')
+        rt.compile('return 1', b'=b')
+        assert rt.compile_cache.info() == CacheInfo(hits + 1, misses + 3, evictions + 1, 2, 2)
+        code = 'x = (x or 0) + 1; local g = _ENV; _ENV = {}; return g.x'
+        assert rt.execute(code) == 1
+        assert rt.execute(code) == 2
+        with pytest.raises(LuaErrSyntax):
+            rt.compile('return +')
+        assert (b'return +', b'=python') not in rt.compile_cache
+        f = rt.compile('return sandboxed')
+        env = rt.table(sandboxed='yes')
+        rt._G.debug.setupvalue(f, 1, env)
+        g = rt.compile('return sandboxed')
+        assert g is not f
+        assert f() == 'yes'
+        assert g() is None
+    with LuaRuntime(compile_cache_size=0) as rt:
+        assert rt.eval('1') == rt.eval('1') == 1
+        assert len(rt.compile_cache) == 0
+        assert rt.compile_cache.info().hits == 0
+
+
+def test_threadsafe_false():
+    with pytest.raises(ValueError):
+        LuaRuntime(threadsafe=False, lock=VoidLock())
+    with LuaRuntime(threadsafe=False) as rt:
+        rt.release_threshold = 4
+        f = rt.eval('function(a, b) return a + b end')
+        assert f(1, 2) == 3
+        errors = []
+        def use():
+            try:
+                f(1, 2)
+            except RuntimeError as e:
+                errors.append(e)
+        t = threading.Thread(target=use)
+        t.start()
+        t.join()
+        assert len(errors) == 1
+        tb = rt.table()
+        objs = [tb.pull(keep=True) for _ in range(3)]
+        refs = sorted(obj._ref for obj in objs)
+        t = threading.Thread(target=objs.clear)
+        t.start()
+        t.join()
+        assert sorted(rt._release_queue) == refs
+        assert f(1, 2) == 3
+        assert rt._release_queue == []
+
+
+def test_memory_limit():
+    with LuaRuntime(memory_limit=4 * 1024 * 1024) as rt:
+        info = rt.memory_info()
+        assert 0 < info.current <= info.peak <= info.limit == 4 * 1024 * 1024
+        assert info.allocations > info.frees > 0
+        with pytest.raises(LuaErrMem, match='not enough memory'):
+            rt.eval('string.rep("x", 8 * 1024 * 1024)')
+        assert rt.memory_info().failures > 0
+        with pytest.raises(LuaErrMem):
+            rt.execute('local t = {} for i = 1, 1e7 do t[i] = i end')
+        assert rt.eval('#string.rep("x", 1024)') == 1024
+        rt.memory_limit = None
+        assert rt.eval('#string.rep("x", 8 * 1024 * 1024)') == 8 * 1024 * 1024
+        assert rt.memory_info().peak > 8 * 1024 * 1024
+    assert lua.memory_limit is None
+    with pytest.raises(ValueError):
+        LuaRuntime(lua_state=lua.lua_state, memory_limit=1)
+
+
+def test_memory_limit_callback():
+    with LuaRuntime(memory_limit=4 * 1024 * 1024) as rt:
+        big = lambda: b'x' * (8 * 1024 * 1024)
+        f = rt.eval('function(big) local n = 0 for i = 1, 20 do n = n + #big() end return n end')
+        assert f(big) == 20 * 8 * 1024 * 1024
+        assert rt.eval('function(g) return g() end')(lambda: 1) == 1
+        with pytest.raises(LuaErrMem):
+            rt.eval('string.rep("x", 8 * 1024 * 1024)')
+
+
+def test_pool_allocator():
+    with pytest.raises(ValueError):
+        LuaRuntime(allocator='awd')
+    rt = LuaRuntime(allocator='pool', memory_limit=64 * 1024 * 1024)
+    assert rt.memory_info().arenas > 0
+    assert rt.eval('''(function()
+        local n = 0
+        for i = 1, 2000 do
+            local t = {i, tostring(i), {x = i}}
+            for j = 1, i % 40 do t[#t + 1] = j end
+            n = n + #t
+        end
+        return n
+    end)()''') == sum(3 + i % 40 for i in range(1, 2001))
+    assert rt.eval('#table.concat({string.rep("a", 1000), "b"})') == 1001
+    info = rt.memory_info()
+    assert info.current <= info.peak
+    assert info.held >= info.arenas * 65536
+    assert info.held >= info.current
+    rt.close()
+    assert lua.memory_info().arenas == 0
+    assert lua.memory_info().held == lua.memory_info().current
+
+
+def test_pool_allocator_limit():
+    limit = 2 * 1024 * 1024
+    rt = LuaRuntime(allocator='pool', memory_limit=limit)
+    churn = rt.eval('''function(size)
+        local t = {}
+        for i = 1, 20000 do t[i] = ("x"):rep(size - 8) .. ("%08d"):format(i) end
+    end''')
+    for size in range(40, 240, 25):
+        try:
+            churn(size)
+        except LuaErrMem:
+            pass
+        rt.gc.collect()
+        assert rt.memory_info().held <= limit
+    assert rt.memory_info().failures > 0
+
+
+def test_json_loads():
+    lua = LuaRuntime()
+    t = lua.json_loads(b' {"a": [1, 2.5, -3e2, true, false, null, "x\\n\\u00e9\\ud83d\\ude00"], "b": {}} ')
+    assert lua.eval('function(t) return math.type(t.a[1]), math.type(t.a[2]), t.a[6], next(t.b) end')(t) == \
+        ('integer', 'float', None, None)
+    assert t.to_python(keys='str', sequence=None)['a'] == \
+        {1: 1, 2: 2.5, 3: -300.0, 4: True, 5: False, 7: 'x\né😀'}
+    assert lua.json_loads('"plain"') == 'plain'
+    assert lua.json_loads('12345678901234567890') == 12345678901234567890.0
+    assert lua.eval('function(t) return math.type(t[1]) end')(lua.json_loads('[7]', integers='float')) == 'float'
+    assert lua.json_loads('null') is None
+    assert lua.eval('function(v) return v == nil, type(v) end')(
+        lua.json_loads('[null]', null='sentinel')[1]) == (False, 'userdata')
+    for bad in ('', '[1,]', '{"a" 1}', '"\\x"', 'nul', '01', '1 2', '"\\ud800"', '[' * 2000):
+        with pytest.raises(ValueError):
+            lua.json_loads(bad)
+    with pytest.raises(ValueError):
+        lua.json_loads('{}', null='none')
+    assert lua.lib.lua_gettop(lua.lua_state) == 0
+
+
+def test_json_dumps():
+    lua = LuaRuntime()
+    assert lua.json_dumps(lua.eval('{1, 2.5, "a\\"\\1", true}')) == b'[1,2.5,"a\\"\\u0001",true]'
+    assert lua.json_dumps(lua.eval('{a = {b = {}}}')) == b'{"a":{"b":{}}}'
+    assert lua.json_dumps(lua.eval('{}'), empty='array') == b'[]'
+    assert lua.json_dumps(lua.eval('{1, 2}'), arrays='never') == b'{"1":1,"2":2}'
+    assert lua.json_dumps(lua.eval('{[1] = 1, [3] = 3}')) in (b'{"1":1,"3":3}', b'{"3":3,"1":1}')
+    assert lua.json_dumps(lua.eval('{[0.5] = 1}')) == b'{"0.5":1}'
+    assert lua.json_dumps(2.0) == b'2'
+    assert lua.json_dumps(2.0, floats='strict') == b'2.0'
+    assert lua.json_dumps(0.1) == b'0.1'
+    assert lua.json_dumps(1 / 3) == repr(1 / 3).encode()
+    assert lua.json_dumps(None) == b'null'
+    assert lua.json_dumps(lua.json_loads('[null]', null='sentinel')) == b'[null]'
+    big = lua.eval('function() local t = {} for i = 1, 1000 do t[i] = ("x"):rep(i) end return t end')()
+    assert lua.json_loads(lua.json_dumps(big)).to_python() == lua.eval('function(t) return t end')(big).to_python()
+    for bad in (lua.eval('{f = print}'), lua.eval('{[true] = 1}'), float('nan'), float('inf'),
+                lua.eval('function() local t = {} t.t = t return t end')()):
+        with pytest.raises(ValueError):
+            lua.json_dumps(bad)
+    with pytest.raises(ValueError):
+        lua.json_dumps(1, arrays='always')
+    assert lua.lib.lua_gettop(lua.lua_state) == 0
@@ -45,6 +45,21 @@ def test_ensure_stack_balance():
         assert lua.lib.lua_gettop(L) == 0
 
 
+def test_stack_balance_unchecked():
+    with LuaRuntime(check_stack_balance=False) as rt:
+        with lock_get_state(rt) as L:
+            top = rt.lib.lua_gettop(L)
+            with assert_stack_balance(rt):
+                rt.lib.lua_pushinteger(L, 1)
+            assert rt.lib.lua_gettop(L) == top
+            rt.lib.lua_pushinteger(L, 1)
+            with ensure_stack_balance(rt):
+                rt.lib.lua_settop(L, top)
+            assert rt.lib.lua_gettop(L) == top + 1
+            rt.lib.lua_settop(L, top)
+        assert rt.table(1, 2)[2] == 2
+
+
 def test_lock_get_state():
     with lock_get_state(lua) as L:
         assert L is lua.lua_state
@@ -109,3 +124,14 @@ def test_reraise():
         assert value2 is not val
         assert isinstance(value2, Exception)
         assert tb is get_next(tb2)
+
+
+def test_lru_cache():
+    c = LRUCache(2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    c.put('c', 3)
+    assert 'b' not in c and 'a' in c and 'c' in c
+    assert c.get('b') is None
+    assert c.info() == CacheInfo(1, 1, 1, 2, 2)